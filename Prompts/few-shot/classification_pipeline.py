@@ -0,0 +1,2176 @@
+"""
+Backend-independent part of the batched classification pipeline shared by the prompt-20 scripts
+(gpt/GPTprompt20.py and together-ai/togetheraiprompt20.py): prompts, rate limiting, retries, parsing,
+caching, checkpointing, batching, the gate/local-model/keyword/cascade/ensemble stages and the command line.
+Each script keeps only its request and transport functions and installs them with use_backend().
+"""
+
+import json
+import copy
+import pickle
+import numpy as np
+import pandas as pd
+import time
+import re
+import os
+import argparse
+import hashlib
+import sqlite3
+import random
+import threading
+import asyncio
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+# Model name
+MODEL_NAME = "model-name"
+
+# Maximum number of batch requests kept in flight at once (1 = sequential)
+MAX_CONCURRENT_REQUESTS = 8
+
+# Async pipeline: run classify_in_batches_async on one event loop instead of a thread pool
+USE_ASYNC = False
+MAX_ASYNC_REQUESTS = 100
+
+# Stream completions and report each comment's result as soon as its block is complete
+STREAM_RESPONSES = False
+
+# Answer format: "text" (Comment #<n> / Classification / Reasoning blocks) or "json" (compact structured output)
+OUTPUT_FORMAT = "text"
+
+# Reasoning-free bulk triage (--no-reasoning): the prompt and output format drop the per-comment reasoning.
+# With EXPLAIN_FLAGGED (--explain-flagged), comments flagged with a harmful category get a second pass with reasoning.
+INCLUDE_REASONING = True
+EXPLAIN_FLAGGED = False
+
+# Two-stage classification (--gate): a short harmful/benign gate prompt screens large batches first,
+# and only the comments it does not clear as benign are sent to the fine-grained prompt
+USE_GATE = False
+GATE_MAX_BATCH_ITEMS = 100
+GATE_MAX_TOKENS_PER_COMMENT = 10
+# A "Benign" verdict below this confidence is still sent to the fine-grained prompt
+GATE_MIN_CONFIDENCE = 0.8
+# Set while the gate pass runs; switches the prompt, the parser and the token sizing to the gate
+GATE_ACTIVE = False
+
+# Local first-stage classifier (--local-model PATH, trained by Prompts/local-model/train_local_classifier.py
+# or distilled from saved LLM labels by Prompts/local-model/distill_llm_labels.py):
+# comments it scores with at least LOCAL_MODEL_THRESHOLD confidence are decided on CPU and never sent to the LLM
+LOCAL_MODEL_PATH = None
+LOCAL_MODEL_THRESHOLD = 0.9
+
+# Keyword prefilter (--keyword-lexicon): every comment is matched against a JSON lexicon of {family: [terms]}
+# (e.g. Prompts/few-shot/keyword_lexicon.json) in one Aho-Corasick pass, and the matched families are written to a
+# keyword_families column. Comments matching no term (KEYWORD_NO_MATCH_FAMILY) are only screened by the gate
+# prompt (KEYWORD_NO_MATCH_ACTION = "gate"), or final as "None" without any request ("skip"; harassment without
+# slurs or gendered terms, such as threats or dismissals, then goes unlabelled)
+KEYWORD_LEXICON_PATH = None
+KEYWORD_NO_MATCH_ACTION = "gate"
+KEYWORD_NO_MATCH_FAMILY = "no-keyword"
+# Confidence written for comments skipped as "None"
+KEYWORD_SKIP_CONFIDENCE = 0.9
+KEYWORD_SKIP_REASONING = "No lexicon keyword matched; skipped by the keyword prefilter."
+
+# Cascade (--cascade): batches go to the first, cheapest model in CASCADE_MODELS (e.g. a small model, then a large one).
+# Comments whose top label is below its CASCADE_THRESHOLDS confidence (CASCADE_DEFAULT_THRESHOLD otherwise),
+# that are flagged harmful (CASCADE_ESCALATE_FLAGGED) or that the model failed on go to the next model;
+# the last model's answer is final
+USE_CASCADE = False
+CASCADE_MODELS = ["small-model-name", MODEL_NAME]
+CASCADE_DEFAULT_THRESHOLD = 0.8
+CASCADE_THRESHOLDS = {"None": 0.9}
+CASCADE_ESCALATE_FLAGGED = True
+
+# Ensemble (--ensemble): the first two ENSEMBLE_MODELS classify every comment in parallel. A comment is final as
+# soon as both answer it with the same labels; only disputed comments go to the third model as tie-breaker.
+# Labels are decided by majority vote and each confidence is the mean over the models asked
+USE_ENSEMBLE = False
+ENSEMBLE_MODELS = [MODEL_NAME, "second-model-name", "tie-breaker-model-name"]
+
+# The model of the cascade tier, ensemble member or gate being run; requests, rate limits and cache keys use it
+# instead of MODEL_NAME. A context variable, so that ensemble members can run in parallel threads
+ACTIVE_MODEL = contextvars.ContextVar("ACTIVE_MODEL", default=None)
+
+# Per-deployment quotas: model name -> (requests per minute, tokens per minute)
+RATE_LIMITS = {
+    MODEL_NAME: (300, 300000),
+    "small-model-name": (600, 600000),
+    "second-model-name": (300, 300000),
+    "tie-breaker-model-name": (300, 300000),
+}
+# Fraction of each quota actually used, to stay just under the 429 threshold
+RATE_LIMIT_HEADROOM = 0.9
+
+# Completion tokens are sized per request (MAX_TOKENS_PER_COMMENT per comment, up to MAX_COMPLETION_TOKENS)
+# so small batches do not over-reserve output tokens. Batch packing budgets the same allowance, so a packed
+# batch always gets its full MAX_TOKENS_PER_COMMENT per comment
+MAX_COMPLETION_TOKENS = 1000
+MAX_TOKENS_PER_COMMENT = 100
+
+# Adaptive batch packing: each request is filled with consecutive comments up to the model's token budget
+# (prompt prefix + comments + expected output), with at most MAX_BATCH_ITEMS comments per request.
+# Budgets are per model name (cascade tier or ensemble member); unlisted models get DEFAULT_REQUEST_TOKEN_BUDGET
+REQUEST_TOKEN_BUDGETS = {
+    MODEL_NAME: 16000,
+    "small-model-name": 8000,
+    "second-model-name": 16000,
+    "tie-breaker-model-name": 16000,
+}
+DEFAULT_REQUEST_TOKEN_BUDGET = 8000
+MAX_BATCH_ITEMS = 20
+# Output allowance per comment when INCLUDE_REASONING is off
+NO_REASONING_MAX_TOKENS_PER_COMMENT = 30
+
+# Comments missing or malformed in a parsed response are resubmitted in sub-batches of this size,
+# for at most MAX_SALVAGE_ROUNDS rounds, instead of silently falling back
+SALVAGE_BATCH_SIZE = 2
+MAX_SALVAGE_ROUNDS = 2
+
+# On-disk cache of per-comment results keyed by model, prompt and normalised comment (None disables it)
+CACHE_PATH = "classification_cache.sqlite3"
+MAX_CACHE_ENTRIES = 1000000
+# Past MAX_CACHE_ENTRIES, evict down to this fraction of it at once, so eviction runs rarely
+CACHE_EVICTION_TARGET = 0.9
+
+# Classify each distinct comment (after case and whitespace normalisation) once per run
+DEDUPLICATE_COMMENTS = True
+
+
+# Exceptions without an HTTP status that are still worth retrying; each backend adds its own transport errors
+RETRYABLE_EXCEPTIONS = (TimeoutError, ConnectionError)
+
+# Categories
+CATEGORIES = [
+    "None", "Discredit", "Stereotyping", "Sexual_Harassment",
+    "Threats_of_Violence", "Maternal_Insults", "Sexual_Objectification",
+    "Anti-LGBTQ+", "Physical_Appearance", "Damning", "Dominance", "Dismissing"
+]
+
+# Column of each category in the confidence matrix
+CATEGORY_INDEX = {cat: i for i, cat in enumerate(CATEGORIES)}
+
+# Category definitions
+CATEGORY_DEFINITIONS = {
+     "None": (  
+        "Label a comment as None if it does not contain any sexist, abusive, threatening, or discriminatory language, and does not target or reference gender, sexual orientation, race, or identity in a negative way."
+        "These comments are typically neutral, technical, supportive, or collaborative — such as questions, suggestions, clarifications, feedback, or status updates."
+        "Even criticism or sarcasm is labeled as None if it:"
+        "- Does not involve gendered insults, sexual content, or identity-based stereotypes."
+        "- Is clearly directed at a product, tool, or general frustration — not at a person or group."
+        "- Uses words like 'mom', 'wife', or 'whore' **only as typos**, jokes, or in non-sexist, non-targeted contexts (e.g., a joke about 'my wife told me…')"
+        "Do not label a comment as harmful based only on the presence of terms like 'nag', 'fugly', 'mom', or 'Cat Woman' **unless they are clearly used in a sexist, mocking, or demeaning way**." 
+        "Only label as harmful if the **intent, tone, and context** indicate sexism, harassment, or identity-based harm. Otherwise, assign None."
+
+    ),
+    
+    "Discredit": (
+        "Label as Discredit only when the comment attacks a woman’s intelligence, competence, legitimacy, or right to participate — especially in technical or professional spaces."
+        "It includes:"
+        "Sarcastic remarks or jokes that question skill (e.g., “go back to the kitchen”)"
+        "Comments that suggest women don’t belong (e.g., “you’re ruining open source”)"
+        "Slurs targeting intelligence when clearly directed at a woman or feminist"
+        "Do not use Discredit for generic meanness, jokes, or frustration that are not gendered."
+        "Do not use Discredit if the insult focuses on appearance, morality, control, or stereotypes — use other categories."
+    ),
+    
+    
+    "Stereotyping": (
+    "Label as Stereotyping when the comment reinforces gender roles, traits, or tropes — even in a joke or indirect way. "
+    "Examples include statements like: "
+    "'Women are too emotional.', "
+    "'That’s such a Karen move.', "
+    "'Blondes are dumb.' "
+    "Do not use for neutral gender mentions (e.g., 'my wife said…'). "
+    "Do not label as Stereotyping unless it assigns a behavior or trait to a gender."
+    ),
+
+
+    "Sexual_Harassment": (
+        "Apply Sexual_Harassment to comments that reference a person’s sexuality, sexual orientation, or sexual behavior in an aggressive, "
+        "hostile, or mocking way. This includes crude innuendos, unwanted advances, sexually explicit language, or using sex to ridicule. "
+        "Sexual jokes, even if indirect, qualify as harassment if they are targeted at a person or group. If the comment simply references attraction without aggression, classify as None."
+    ),
+
+    "Threats_of_Violence": (
+        "Use Threats_of_Violence for any comment that expresses intent or desire to harm a woman or her family physically — including rape, "
+        "murder, assault, or violent threats. This applies even if the comment is framed as a joke or mixed with other categories. "
+        "Violent threats may be sexual or non-sexual, direct or implied."
+    ),
+
+    "Maternal_Insults": (
+        "Label a comment as Maternal_Insults when it insults, mocks, or demeans someone's mother, sister, grandmother, girlfriend, wife, or other "
+        "female relative. The insult must target the person through that female figure, using family-based insults or jokes — but not focusing on appearance. "
+        "If the insult is appearance-based, label it as Physical_Appearance instead."
+    ),
+
+    "Sexual_Objectification": (
+        "Label a comment as Sexual Objectification when it reduces someone to a body part, sexual function, or purpose — often with degrading, possessive, or commodifying intent."
+        "Includes:"
+        "Explicitly treating women as tools for sexual use or viewing pleasure."
+        "Describing women as sexual parts or sex objects (e.g., “ass”, “cum dump”, “trophy”)."
+        "Do not apply if the comment uses anatomical or sexual terms in a medical, biological, or non-targeted context." 
+        "If the content is sexually themed but not objectifying, use Sexual Harassment instead."
+    ),
+
+    "Anti-LGBTQ+": (
+        "Apply Anti-LGBTQ+ when the comment expresses hostility, slurs, or ridicule toward LGBTQ+ identities. This includes mockery using LGBTQ+ terms as insults, "
+        "denying LGBTQ+ existence or validity, or associating queerness with weakness, wrongness, or shame. If the comment neutrally references LGBTQ+ identity (e.g., 'LGBTQ+ inclusion matters'), label it as None."
+    ),
+
+    "Physical_Appearance": (
+        "Use Physical_Appearance when the comment insults or mocks someone’s looks, body, weight, height, facial features, or clothing. If the comment focuses on "
+        "how a person (or their female relative) looks — even as a joke — this is the correct label. Do not use this for sexual objectification or moral judgment."
+    ),
+
+    "Damning": (
+        "Label as Damning when the comment expresses strong moral condemnation or emotional rejection of a woman — such as calling her disgusting, shameful, evil, or unwanted. "
+        "These comments are often emotionally intense, contemptuous, or wish for harm (e.g., 'go to hell', 'may she disappear'). This is different from Discredit, which targets competence, "
+        "and from Dominance, which asserts control."
+    ),
+
+    "Dominance": (
+        "Assign Dominance when the speaker asserts control, superiority, or authority over a woman — often using a commanding, dismissive, or condescending tone. "
+        "This includes comments that silence women, question their right to speak, gatekeep their presence, or suggest they are less capable. It focuses on maintaining male control or superiority."
+    ),
+
+    "Dismissing": (
+        "Label a comment as Dismissing when it responds to **someone’s report of harassment, abuse, or mistreatment** "
+        "by doing any of the following:\n"
+        "1️**Minimization**: Downplaying the seriousness of the situation (e.g., 'Are you sure this really happened? Maybe you're overreacting.')\n"
+        "2️**Deflection**: Shifting responsibility away from the accused (e.g., 'Not saying it’s not true, but you should have reported it sooner.')\n"
+        "3️ **Silencing**: Discouraging discussion of the issue (e.g., 'We’re here to code, not deal with drama.')\n"
+        "4️**Blame Shifting**: Suggesting the victim’s actions caused the problem (e.g., 'Maybe if you dressed differently, this wouldn't have happened.')\n"
+        "\n**Never classify as None if any of these patterns appear.** Even if the tone is polite, rational, or indirect, "
+        "if the comment shifts blame away from the perpetrator or undermines the victim’s experience, classify it as Dismissing."
+    )
+    }
+
+# ew-Shot Examples
+FEW_SHOT_EXAMPLES_TEXT = """
+Example 1:
+Comment: "SAM6969 January 1 2022 OH so small thing Could someone check for things like the Headmistresses first reward the mandatory one and see if they can change the part where she calles the player a manwhore to the female one Im trans feme so I have my set up as Pet Feminine body but with a penis and I made sure it was that way before this happened and Id like to be degraded being called feminine things."
+Classification: Anti-LGBTQ+ (0.92)
+Reasoning: Uses language that devalues trans identity and promotes derogatory remarks.
+
+Example 2:
+Comment: "Fix your bot is kinda gay i think."
+Classification: Anti-LGBTQ+ (0.91)
+Reasoning: Uses "gay" as an insult to criticize a system.
+
+Example 3:
+Comment: "Women cant pushop with animation When women go for pushups they cant do the animation like men."
+Classification: Stereotyping (0.94)
+Reasoning: Reinforces a stereotype that women are physically weaker.
+
+Example 4:
+Comment: "What does a blonde do when her computer freezes? She sticks it in the microwave."
+Classification: Stereotyping (0.92)
+Reasoning: Reinforces the stereotype that blond women lack intelligence.
+
+Example 5:
+Comment: "You should smile more, sweetheart."
+Classification: Sexual Harassment (0.93)
+Reasoning: Unwanted gendered command that enforces gender norms.
+
+Example 6:
+Comment: "You too can be lesbian."
+Classification: Sexual Harassment (0.91)
+Reasoning: Suggests unwanted sexualization in a dismissive tone.
+
+Example 7:
+Comment: "Going to McDonald's for a salad is like going to a whore for a hug."
+Classification: Sexual Objectification (0.92)
+Reasoning: Compares a woman’s profession to an object of sexual availability.
+
+Example 8:
+Comment: "Your sissyness increases before you select licking the cum off."
+Classification: Sexual Objectification (0.95)
+Reasoning: Reduces a person to a degrading sexual act.
+
+Example 9:
+Comment: "Your moms U are a very pretty girl."
+Classification: Maternal_Insults (0.91)
+Reasoning: Targets a female relative while making a condescending statement.
+
+Example 10:
+Comment: "Whot is it Does your sister go to school every morning How are you."
+Classification: Maternal_Insults (0.90)
+Reasoning: Makes an unnecessary and indirect remark about a female relative.
+
+Example 11:
+Comment: "Your momma so ugly when Santa saw her he said HOHOHOLY SHIT."
+Classification: Physical_Appearance (0.91)
+Reasoning: Insults physical appearance in a derogatory way.
+
+Example 12:
+Comment: "Your mom is so fat she doesn’t need internet because she's already worldwide."
+Classification: Physical_Appearance (0.92)
+Reasoning: Insults body size using a joke.
+
+Example 13:
+Comment: "I will rape ur grandma."
+Classification: Threats_of_Violence (0.97)
+Reasoning: Explicitly threatens sexual violence against a female relative.
+
+Example 14:
+Comment: "I will find you and put you in prison. Then will fuck your mother you son of bitch."
+Classification: Threats_of_Violence (0.95)
+Reasoning: Combines a physical threat with an explicit reference to sexual violence.
+
+Example 15:
+Comment: "whats with the retarded question you dumb cunt."
+Classification: Discredit (0.93)
+Reasoning: Uses insults and demeaning language to attack intelligence.
+
+Example 16:
+Comment: "Whats the difference between a feminist and a bomb vest? A bomb vest accomplishes something when it's TRIGGERED."
+Classification: Discredit (0.94)
+Reasoning: Mocks and belittles feminists using an inflammatory joke.
+
+Example 17:
+Comment: "She only whines to get visibility. Die, you whining bitch."
+Classification: Damning (0.97)
+Reasoning: Strong moral condemnation mixed with dehumanization.
+
+Example 18:
+Comment: "You dont belong here. Get lost before something happens to you."
+Classification: Damning (0.95)
+Reasoning: Dismisses and excludes the individual while implying a threat.
+
+Example 19:
+Comment: "I get that you feel uncomfortable, but are you sure it wasn’t just a misunderstanding?"
+Classification: Dismissing (0.92)
+Reasoning: Questions the victim’s perception, implying overreaction.
+
+Example 20:
+Comment: "I'm not saying it didn’t happen, but bringing it up here just makes things messy."
+Classification: Dismissing (0.90)
+Reasoning: Frames reporting harassment as disruptive rather than valid.
+
+Example 21:
+Comment: "I hate women. Let's get rid of women."
+Classification: Dominance (0.96)
+Reasoning: Calls for the exclusion and erasure of women.
+
+Example 22:
+Comment: "Get back in the sea, you finned cunt."
+Classification: Dominance (0.92)
+Reasoning: Uses derogatory language to assert power and control.
+
+Example 23:
+Comment: "Fix your CSS, woman."
+Classification: Dominance (0.91)
+Reasoning: Uses a condescending and dismissive tone toward women in a technical setting.
+
+Example 24:
+Comment: "Can you write a spec for this code?"
+Classification: None (0.98)
+Reasoning: A neutral request that does not contain any sexist or abusive language.
+
+Example 25:
+Comment: "Thanks, I like that solution."
+Classification: None (0.98)
+Reasoning: A polite response that is free of bias or negativity.
+
+Example 26:
+Comment: "That's just how girls are. No need to bring it up here."
+Classification: Stereotyping (0.91), Dismissing (0.89)
+Reasoning: Reinforces a gender stereotype and dismisses discussion.
+
+Example 27:
+Comment: "You call that an error? Maybe you should go back to cooking."
+Classification: Discredit (0.94), Dominance (0.89)
+Reasoning: Undermines competence using a sexist jab.
+
+Example 28
+Comment: "My wife told me to stop impersonating a flamingo. I had to put my foot down."
+Classification: None (0.97)
+Reasoning: Harmless joke referencing a spouse, no sexist stereotype or intent.
+
+Example 29
+Comment: "What happened to the sister job? The parent process is crashing at deletion."
+Classification: None (0.96)
+Reasoning: Technical language using “sister” and “parent” in a system context, not about gender.
+
+Example 30
+Comment: "Is your mum working today?"
+Classification: None (0.95)
+Reasoning: Generic question — no insult or mocking of maternal figure.
+
+Example 31
+Comment: "Can we have less lewd jokes in the README and maybe more formal examples?"
+Classification: None (0.96)
+Reasoning: Constructive suggestion about tone — not harassing or promoting sexual content.
+
+Example 32
+Comment: "It would be nice to skip the whole Params array in some cases."
+Classification: None (0.97)
+Reasoning: Typo-prone word like "whole" could be misread (e.g., as “whore”) — but here it’s clearly technical.
+
+Example 33
+Comment: "Looks fugly, might need better UI spacing."
+Classification: None (0.95)
+Reasoning: Informal criticism of design — no gender or identity reference.
+
+"""
+
+# Batch classification prompt with definitions and few-shot examples
+BATCH_CLASSIFICATION_PROMPT = f"""
+You are a maintainer of an open source project on GitHub. You aim to maintain inclusive environment for persons representing various gender identities. 
+Your task is to identify and classify any harmful sexist or misogynistic content in each comment categories: {", ".join(CATEGORIES)}.
+
+Category Definitions:
+{chr(10).join([f"- {cat}: {definition}" for cat, definition in CATEGORY_DEFINITIONS.items()])}
+
+Few-Shot Examples:
+{FEW_SHOT_EXAMPLES_TEXT}
+
+Guidelines:
+1. Analyze each comment carefully. If no harmful sexist content is found, return the classification as "None" with a confidence score ≥ 0.95.
+2. If harmful content exists, select one or more relevant categories from the list.
+3. For each assigned category, provide a confidence score between 0.00 and 1.00.
+4. Write a short reasoning (maximum 20 words) justifying your classification.
+5. **Important:** Output your answer in exactly the following format without any additional commentary:
+
+Notes:
+### NOTES: How to Handle Confusing, Overlapping, or Borderline Cases
+
+To ensure highly accurate classification of harmful content, follow these special-case handling rules based on observed misclassifications and nuanced human logic:
+
+---
+
+#### 1. Handle Borderline or Overlapping Cases Using First-Fit + Dominant Intent
+- Prioritize the *dominant harmful intent* in the comment. If a comment contains multiple possible labels (e.g., insult + sexual reference), assign the one that captures the **main harm** or **strongest target**.
+- Do **not stack multiple labels** unless both are **equally explicit and independent**. Avoid over-labeling vague overlaps.
+
+**Example**:  
+Comment: “UR MOM GAY1”  
+→ Assign: `Maternal_Insults, Anti-LGBTQ+` (because both insults are clear, intentional, and target different dimensions).  
+
+---
+
+####  2. Handle Tone Carefully – Do Not Be Over-Conservative
+- **Tone matters** only **if it strengthens harmful content**.  
+- Do **not label** something harmful **just because it sounds angry, sarcastic, vulgar, or rude**.
+- **Only classify as harmful when the content itself is sexist, discriminatory, threatening, or degrading.**
+
+**Example**:  
+Comment: “Fix your CSS, woman.”  
+→ Harm comes from **gendered condescension**, not the command tone alone.
+
+---
+
+####  3. Prioritize Content and Target, Not Emotion
+- Focus on **what is being said**, **who it's targeting**, and **why** — not how angry or emotional it sounds.
+- If the **comment is directed at a tool, feature, or bug**, label it as `None`, even if harsh or vulgar.
+
+**Wrong**: Labeling “This shit design is dumb as hell” as harmful.  
+**Right**: Label as `None` — no identity or gender is targeted.
+
+---
+
+#### 4. Handle Misclassified Technical or Vulgar Comments as Neutral
+- **Do not label profanity as harmful by default.**
+- If a comment uses slang, swearing, or frustration **without targeting a person or identity**, it is `None`.
+
+**Examples of `None` despite harsh language**:
+- “WTF is this bug? Crashed again.”
+- “God damn this UI is terrible.”
+
+---
+
+#### 5. Differentiate Sexual Harassment vs. Sexual Objectification
+- Use **Sexual_Harassment** if the comment includes **sexual jokes, innuendos, or mockery** of someone’s sexuality, behavior, or presence in a sexual way — **especially when used to ridicule**.
+- Use **Sexual_Objectification** only when someone is **explicitly reduced to a sexual body part, role, or object** (e.g., “cum dump”, “trophy”).
+
+**Rule of Thumb**:
+- **Mocking or sexual teasing → Harassment**
+- **Dehumanizing into a sexual thing → Objectification**
+
+---
+
+#### 6. Distinguish Maternal_Insults vs. Physical_Appearance
+- Use **Maternal_Insults** if the insult targets someone's **mom, sister, wife, or female relative**, regardless of whether it’s direct or joking — **unless the focus is on looks**.
+- Use **Physical_Appearance** if the **focus is appearance-based** (e.g., fat, ugly), even if it mentions “mom”.
+
+**Examples**:
+- “Your momma so fat she blocks the sun.” → `Physical_Appearance`
+- “Your mom is a slut and you’re dumb.” → `Maternal_Insults`
+
+---
+
+#### 7. Handle Ambiguity by Requiring Clear Evidence
+- If you're **not sure** whether something is harmful:
+  - Check if there is a **clear gender, sexuality, or identity-based implication**.
+  - If not — or if it's just unclear sarcasm or humor — label as `None`.
+
+**Better to miss a borderline case than to over-label.**
+
+---
+####  8. When in Doubt: Ask
+Use the “None” label **only** if the comment is:
+- **Neutral, technical, or constructive**
+- **Not mocking or targeting identity**
+- **Free of sexist, sexual, threatening, or identity-based language**
+
+Do **not** penalize for edgy humor unless it **targets gender, sexuality, or identity**.
+
+---
+
+### Summary Decision Framework
+
+| **Check**                             | **If True** → Apply Label             |
+|--------------------------------------|----------------------------------------|
+| Identity or sexuality mocked         | Anti-LGBTQ+                            |
+| Gender role, trope, or trait invoked | Stereotyping                           |
+| Sexual reference used to mock        | Sexual_Harassment                      |
+| Reduced to sex/body role             | Sexual_Objectification                 |
+| Female relative insulted (not looks) | Maternal_Insults                       |
+| Female relative mocked for looks     | Physical_Appearance                    |
+| Threat, rape, violence mentioned     | Threats_of_Violence                    |
+| Competence or legitimacy mocked      | Discredit                              |
+| Harsh moral rejection, exclusion     | Damning                                |
+| Assertive dominance, silencing       | Dominance                              |
+| Undermines abuse/harassment report   | Dismissing                             |
+| Neutral, technical, or civil         | None                                   |
+
+
+"""
+
+
+"""
+
+
+Format:
+Comment #<number>:
+Classification: Category1 (confidence), Category2 (confidence), ...
+Reasoning: <explanation>
+
+Now classify the following comments:
+"""
+
+# JSON output mode: the same prompt followed by a compact answer format using category indices
+JSON_OUTPUT_FORMAT = f"""Format (a single JSON object, no other text):
+{{"results": [{{"id": <comment number>, "labels": [<category index>, ...], "conf": [<confidence per label>, ...], "reasoning": "<explanation>"}}, ...]}}
+Category indices: {", ".join(f"{i}={cat}" for i, cat in enumerate(CATEGORIES))}
+"""
+
+# Appended after the unchanged prompt so the JSON-mode prefix is also byte-identical across requests
+JSON_BATCH_CLASSIFICATION_PROMPT = BATCH_CLASSIFICATION_PROMPT + JSON_OUTPUT_FORMAT
+
+JSON_OUTPUT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "id": {"type": "integer"},
+                    "labels": {"type": "array", "items": {"type": "integer"}},
+                    "conf": {"type": "array", "items": {"type": "number"}},
+                    "reasoning": {"type": "string"}
+                },
+                "required": ["id", "labels", "conf", "reasoning"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["results"],
+    "additionalProperties": False
+}
+
+# Reasoning-free variant: no reasoning instruction and no Reasoning lines in the few-shot examples
+NO_REASONING_PROMPT = re.sub(r"^Reasoning: .*\n", "", BATCH_CLASSIFICATION_PROMPT, flags=re.MULTILINE).replace(
+    "4. Write a short reasoning (maximum 20 words) justifying your classification.",
+    "4. Do not write any reasoning or explanation; output only the classification of each comment."
+)
+
+TEXT_NO_REASONING_FORMAT = """Format (no reasoning, no other text):
+Comment #<number>:
+Classification: Category1 (confidence), Category2 (confidence), ...
+"""
+
+JSON_NO_REASONING_FORMAT = f"""Format (a single JSON object, no other text):
+{{"results": [{{"id": <comment number>, "labels": [<category index>, ...], "conf": [<confidence per label>, ...]}}, ...]}}
+Category indices: {", ".join(f"{i}={cat}" for i, cat in enumerate(CATEGORIES))}
+"""
+
+JSON_NO_REASONING_SCHEMA = copy.deepcopy(JSON_OUTPUT_SCHEMA)
+del JSON_NO_REASONING_SCHEMA["properties"]["results"]["items"]["properties"]["reasoning"]
+JSON_NO_REASONING_SCHEMA["properties"]["results"]["items"]["required"].remove("reasoning")
+
+# (OUTPUT_FORMAT, INCLUDE_REASONING) -> static prompt prefix
+CLASSIFICATION_PROMPTS = {
+    ("text", True): BATCH_CLASSIFICATION_PROMPT,
+    ("json", True): JSON_BATCH_CLASSIFICATION_PROMPT,
+    ("text", False): NO_REASONING_PROMPT + TEXT_NO_REASONING_FORMAT,
+    ("json", False): NO_REASONING_PROMPT + JSON_NO_REASONING_FORMAT,
+}
+
+# First stage of a two-stage run: a binary screen without definitions or few-shot examples
+GATE_PROMPT = """
+You are a maintainer of an open source project on GitHub screening comments for sexist or misogynistic content.
+A comment is Harmful if it does any of the following, otherwise it is Benign:
+- mocks someone's competence or legitimacy because of their gender
+- invokes gender stereotypes, roles or traits
+- makes sexual remarks or references, or reduces someone to their body or to sex
+- threatens violence or sexual violence
+- insults or mocks someone's mother or other female relatives
+- mocks sexual orientation or gender identity
+- harshly condemns, excludes or silences someone on gendered grounds
+- dismisses or undermines a report of abuse or harassment
+Technical disagreement, blunt code review and profanity that does not target gender, sexuality or identity are Benign.
+If unsure, answer Harmful.
+
+Format (one line per comment, no other text):
+Comment #<number>: Harmful (confidence)
+Comment #<number>: Benign (confidence)
+
+Now screen the following comments:
+"""
+
+# Reasoning of rows the gate clears without a fine-grained pass
+GATE_CLEARED_REASONING = "Cleared as benign by the gate prompt."
+# Reasoning of rows decided by the local classifier
+LOCAL_MODEL_REASONING = "Decided by the local classifier."
+
+def classification_prompt() -> str:
+    """
+    The static prompt prefix for the configured OUTPUT_FORMAT and INCLUDE_REASONING (GATE_PROMPT during the gate pass).
+    """
+    if GATE_ACTIVE:
+        return GATE_PROMPT
+    return CLASSIFICATION_PROMPTS[(OUTPUT_FORMAT, INCLUDE_REASONING)]
+
+def active_model() -> str:
+    """
+    The model requests currently go to: the cascade tier or ensemble member being run, otherwise MODEL_NAME.
+    """
+    return ACTIVE_MODEL.get() or MODEL_NAME
+
+class TokenBucketRateLimiter:
+    """
+    Meters requests and estimated tokens against a deployment's per-minute quotas.
+    Both buckets refill continuously; a caller reserves one request plus its token estimate and
+    waits until both buckets have recovered, so concurrent workers are spread evenly under the quota.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.request_capacity = requests_per_minute
+        self.token_capacity = tokens_per_minute
+        self.request_level = requests_per_minute
+        self.token_level = tokens_per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _reserve(self, tokens: int) -> float:
+        """
+        Deducts the reservation from both buckets and returns how many seconds the caller must wait.
+        Levels may go negative; later callers then queue behind the outstanding debt.
+        """
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.updated
+            self.updated = now
+            self.request_level = min(self.request_capacity, self.request_level + elapsed * self.request_capacity / 60)
+            self.token_level = min(self.token_capacity, self.token_level + elapsed * self.token_capacity / 60)
+            # A single request larger than the whole bucket would otherwise never fit
+            self.request_level -= 1
+            self.token_level -= min(tokens, self.token_capacity)
+            return max(
+                0.0,
+                -self.request_level * 60 / self.request_capacity,
+                -self.token_level * 60 / self.token_capacity
+            )
+
+    def acquire(self, tokens: int):
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens: int):
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def settle(self, reserved: int, actual):
+        """
+        Returns over-reserved tokens to the bucket once the real usage of a request is known
+        (0 for an attempt that failed before a response arrived, which refunds its whole reservation).
+        """
+        if actual is None:
+            return
+        with self.lock:
+            # _reserve never takes more than the bucket holds, so never refund more than that either
+            taken = min(reserved, self.token_capacity)
+            self.token_level = min(self.token_capacity, self.token_level + taken - actual)
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(model: str):
+    """
+    Returns the shared limiter for a deployment, or None if no quota is configured for it.
+    """
+    if model not in RATE_LIMITS:
+        return None
+    with _rate_limiters_lock:
+        if model not in _rate_limiters:
+            requests_per_minute, tokens_per_minute = RATE_LIMITS[model]
+            _rate_limiters[model] = TokenBucketRateLimiter(
+                requests_per_minute * RATE_LIMIT_HEADROOM,
+                tokens_per_minute * RATE_LIMIT_HEADROOM
+            )
+        return _rate_limiters[model]
+
+class RetryPolicy:
+    """
+    Decides whether a failed request is worth retrying and how long to wait before the next attempt.
+    Throttling, server errors, timeouts and dropped connections are retried with exponential backoff
+    and full jitter (or the server's Retry-After hint); client errors such as an over-long prompt or
+    a bad key fail immediately.
+    """
+
+    RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+    def __init__(self, max_attempts: int = 5, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @staticmethod
+    def status_code(error):
+        for attr in ("status_code", "status", "http_status"):
+            code = getattr(error, attr, None)
+            if isinstance(code, int):
+                return code
+        response = getattr(error, "response", None)
+        code = getattr(response, "status_code", None)
+        return code if isinstance(code, int) else None
+
+    @staticmethod
+    def retry_after(error):
+        """
+        Returns the server-requested wait in seconds from Retry-After style headers, if present.
+        """
+        headers = getattr(getattr(error, "response", None), "headers", None) or getattr(error, "headers", None)
+        if not headers:
+            return None
+        try:
+            if headers.get("retry-after-ms"):
+                return float(headers["retry-after-ms"]) / 1000
+            value = headers.get("retry-after")
+            if not value:
+                return None
+            try:
+                return float(value)
+            except ValueError:
+                retry_at = parsedate_to_datetime(value)
+                return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+    def is_retryable(self, error) -> bool:
+        code = self.status_code(error)
+        if code is not None:
+            return code in self.RETRYABLE_STATUS_CODES or code >= 500
+        return isinstance(error, RETRYABLE_EXCEPTIONS)
+
+    def is_context_length_error(self, error) -> bool:
+        """
+        True for 400 errors caused by the prompt exceeding the model's context window.
+        """
+        if self.status_code(error) != 400:
+            return False
+        message = str(error).lower()
+        return "context" in message or ("maximum" in message and "token" in message)
+
+    def delay(self, attempt: int, error) -> float:
+        """
+        Seconds to sleep after the given (1-based) failed attempt.
+        """
+        server_delay = self.retry_after(error)
+        if server_delay is not None:
+            # Small jitter on top so workers throttled together do not return together
+            return min(self.max_delay, server_delay) + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+RETRY_POLICY = RetryPolicy()
+
+class UsageStats:
+    """
+    Thread-safe running totals of the token usage reported by the service,
+    including the prompt tokens served from the provider's prefix cache.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+
+    def record(self, prompt_tokens: int, completion_tokens: int, cached_tokens: int):
+        with self.lock:
+            self.requests += 1
+            self.prompt_tokens += prompt_tokens or 0
+            self.completion_tokens += completion_tokens or 0
+            self.cached_tokens += cached_tokens or 0
+
+    def summary(self) -> str:
+        with self.lock:
+            cached_share = self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+            return (f"{self.requests} requests, {self.prompt_tokens} prompt tokens "
+                    f"({self.cached_tokens} cached, {cached_share:.0%}), {self.completion_tokens} completion tokens")
+
+USAGE_STATS = UsageStats()
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count (about four characters per token) used to reserve quota before a request is sent.
+    """
+    return len(text) // 4 + 1
+
+# Compiled once; "Comment #<n>:" headers delimit the blocks of a batched response
+COMMENT_HEADER_PATTERN = re.compile(r"Comment\s+#(\d+):")
+# Category names may be written with spaces ("Sexual Harassment") and are normalised by canonical_category
+CLASSIFICATION_ENTRY_PATTERN = re.compile(r"([\w+\-]+(?:\s+[\w+\-]+)*)\s*\(([0-9.]+)\)")
+CATEGORY_SEPARATORS_PATTERN = re.compile(r"[\s_\-]+")
+# Gate verdict following a "Comment #<n>:" header, e.g. "Benign (0.97)"
+GATE_VERDICT_PATTERN = re.compile(r"\s*(harmful|benign)\b\s*(?:\(([0-9.]+)\))?", re.IGNORECASE)
+
+# Lookup of categories ignoring case, spaces, underscores and hyphens
+CATEGORY_ALIASES = {CATEGORY_SEPARATORS_PATTERN.sub("", cat).lower(): cat for cat in CATEGORIES}
+
+def canonical_category(name: str):
+    """
+    Maps a category as written by the model (e.g. "Sexual Harassment", "anti-lgbtq+") to its
+    name in CATEGORIES, or None if it is not a known category.
+    """
+    return CATEGORY_ALIASES.get(CATEGORY_SEPARATORS_PATTERN.sub("", name).lower())
+
+def parse_comment_block(body: str):
+    """
+    Parses the text following one "Comment #<n>:" header.
+    Returns {"classification": [...], "reasoning": ...}, or None if the block has no Classification line.
+    The Reasoning line is optional (reasoning-free runs); without it the reasoning is empty.
+    """
+    body = body.lstrip()
+    if not body.startswith("Classification:"):
+        return None
+    # Plain substring search; the classification ends at the first "Reasoning:", if any
+    split = body.find("Reasoning:", len("Classification:"))
+    if split < 0:
+        split = len(body)
+    classification_str = body[len("Classification:"):split].strip()
+    if not classification_str:
+        return None
+    classifications = []
+    # Check if the entire classification string is "None" (case-insensitive)
+    if classification_str.lower() == "none":
+        classifications.append({"category": "None", "confidence": 1.0})
+    else:
+        for entry in classification_str.split(","):
+            em = CLASSIFICATION_ENTRY_PATTERN.match(entry.strip())
+            category = canonical_category(em.group(1)) if em else None
+            if category:
+                try:
+                    confidence = float(em.group(2))
+                except ValueError:
+                    continue
+                classifications.append({"category": category, "confidence": confidence})
+    return {"classification": classifications, "reasoning": body[split + len("Reasoning:"):].strip()}
+
+def parse_gate_block(body: str):
+    """
+    Parses a gate verdict ("Harmful (0.90)" or "Benign (0.97)") following one "Comment #<n>:" header.
+    Returns a result whose single category is "Harmful" or "None", or None if there is no verdict.
+    A verdict without a confidence counts as 1.0, like an unscored "None" classification.
+    """
+    vm = GATE_VERDICT_PATTERN.match(body)
+    if not vm:
+        return None
+    try:
+        confidence = float(vm.group(2)) if vm.group(2) else 1.0
+    except ValueError:
+        return None
+    category = "Harmful" if vm.group(1).lower() == "harmful" else "None"
+    return {"classification": [{"category": category, "confidence": confidence}], "reasoning": ""}
+
+class BatchResponseParser:
+    """
+    Incremental parser for batched responses. Text can be fed in arbitrary pieces (e.g. streamed tokens);
+    a comment's block is parsed and emitted as soon as the next "Comment #<n>:" header arrives,
+    and close() emits the final block. Each block is scanned once, by `parse_block`.
+    """
+
+    def __init__(self, parse_block=parse_comment_block):
+        self.parse_block = parse_block
+        self.buffer = ""
+        # Comment number of the block at the start of the buffer, and where its body begins
+        self.number = None
+        self.body_start = 0
+
+    def feed(self, text: str) -> dict:
+        """
+        Adds text to the buffer and returns {comment number: result} for every block completed by it.
+        """
+        self.buffer += text
+        completed = {}
+        # Resume scanning where the current block's body starts; earlier text is already consumed
+        for header in COMMENT_HEADER_PATTERN.finditer(self.buffer, self.body_start):
+            self._emit(completed, self.buffer[self.body_start:header.start()])
+            self.number = int(header.group(1))
+            self.body_start = header.end()
+        if self.number is None:
+            # Keep only a possible partial header from the preamble
+            self.buffer = self.buffer[-64:]
+            self.body_start = 0
+        elif self.body_start:
+            self.buffer = self.buffer[self.body_start:]
+            self.body_start = 0
+        return completed
+
+    def close(self) -> dict:
+        """
+        Parses and returns the block still in the buffer once the response has ended.
+        """
+        completed = {}
+        self._emit(completed, self.buffer[self.body_start:])
+        self.buffer = ""
+        self.number = None
+        self.body_start = 0
+        return completed
+
+    def _emit(self, completed: dict, body: str):
+        if self.number is None:
+            return
+        result = self.parse_block(body)
+        if result is not None:
+            completed[self.number] = result
+
+def parse_batch_classification(text: str) -> dict:
+    """
+    Parses the batched LLM response.
+    Expected format per comment:
+      Comment #<number>:
+      Classification: Category1 (confidence), Category2 (confidence), ...
+      Reasoning: <explanation>   (absent in reasoning-free runs)
+    Returns a dictionary mapping comment numbers to their classification and reasoning.
+    """
+    parser = BatchResponseParser()
+    results = parser.feed(text)
+    results.update(parser.close())
+    return results
+
+def parse_json_item(item):
+    """
+    Converts one {"id", "labels", "conf", "reasoning"} element of a JSON-mode response to
+    (comment number, result), or returns None if it has no usable id.
+    Labels may be category indices or category names.
+    """
+    if not isinstance(item, dict):
+        return None
+    try:
+        number = int(item["id"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    classifications = []
+    for label, conf in zip(item.get("labels") or [], item.get("conf") or []):
+        if isinstance(label, int) and 0 <= label < len(CATEGORIES):
+            category = CATEGORIES[label]
+        elif isinstance(label, str):
+            category = canonical_category(label)
+        else:
+            category = None
+        try:
+            confidence = float(conf)
+        except (TypeError, ValueError):
+            continue
+        if category:
+            classifications.append({"category": category, "confidence": confidence})
+    return number, {"classification": classifications, "reasoning": str(item.get("reasoning") or "").strip()}
+
+class JsonBatchResponseParser:
+    """
+    Incremental parser for JSON-mode responses ({"results": [{...}, ...]}) with the same feed()/close()
+    interface as BatchResponseParser. Each element of the results array is decoded as soon as it is
+    complete, so streamed and truncated responses still yield every finished comment.
+    """
+
+    decoder = json.JSONDecoder()
+
+    def __init__(self):
+        self.buffer = ""
+        # Position of the next element once the results array has opened
+        self.pos = None
+        self.done = False
+
+    def feed(self, text: str) -> dict:
+        self.buffer += text
+        completed = {}
+        if self.done:
+            return completed
+        if self.pos is None:
+            start = self.buffer.find("[")
+            if start < 0:
+                return completed
+            self.pos = start + 1
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n,":
+                self.pos += 1
+            if self.pos >= len(self.buffer):
+                break
+            if self.buffer[self.pos] == "]":
+                self.done = True
+                break
+            try:
+                item, self.pos = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # Incomplete element; wait for more text
+                break
+            parsed = parse_json_item(item)
+            if parsed:
+                completed[parsed[0]] = parsed[1]
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        return completed
+
+    def close(self) -> dict:
+        completed = self.feed("")
+        self.buffer = ""
+        self.pos = None
+        self.done = False
+        return completed
+
+def parse_batch_classification_json(text: str) -> dict:
+    """
+    Parses a JSON-mode response into the same {comment number: result} form as parse_batch_classification.
+    Elements cut off by truncation or otherwise malformed are left out.
+    """
+    parser = JsonBatchResponseParser()
+    results = parser.feed(text)
+    results.update(parser.close())
+    return results
+
+def make_response_parser():
+    """
+    Incremental parser for the configured OUTPUT_FORMAT, or for gate verdicts during the gate pass.
+    """
+    if GATE_ACTIVE:
+        return BatchResponseParser(parse_gate_block)
+    return JsonBatchResponseParser() if OUTPUT_FORMAT == "json" else BatchResponseParser()
+
+def parse_response(text: str) -> dict:
+    """
+    Parses a batched response in the configured OUTPUT_FORMAT, or the gate verdicts during the gate pass.
+    """
+    if GATE_ACTIVE:
+        parser = make_response_parser()
+        results = parser.feed(text)
+        results.update(parser.close())
+        return results
+    return parse_batch_classification_json(text) if OUTPUT_FORMAT == "json" else parse_batch_classification(text)
+
+def normalize_comment(comment) -> str:
+    """
+    Canonical form of a comment for hashing: case-folded with runs of whitespace collapsed.
+    """
+    return " ".join(str(comment).split()).casefold()
+
+def deduplicate(comments: list) -> tuple:
+    """
+    Collapses comments that are identical after normalize_comment.
+    Returns (unique comments, groups), where groups[k] lists the 1-based indices of all original
+    comments represented by unique comment k + 1.
+    """
+    if not DEDUPLICATE_COMMENTS:
+        return comments, [[i] for i in range(1, len(comments) + 1)]
+    unique_comments = []
+    groups = []
+    seen = {}
+    for i, comment in enumerate(comments, 1):
+        key = normalize_comment(comment)
+        if key not in seen:
+            seen[key] = len(unique_comments)
+            unique_comments.append(comment)
+            groups.append([])
+        groups[seen[key]].append(i)
+    return unique_comments, groups
+
+def fan_out(results: dict, groups: list) -> dict:
+    """
+    Copies each unique comment's result back to every original index it represents.
+    """
+    return {i: res for k, res in results.items() for i in groups[k - 1]}
+
+class ResponseCache:
+    """
+    SQLite-backed cache of per-comment classification results.
+    Entries are keyed by a hash of the model, the prompt and the normalised comment; the raw response
+    each result was parsed from is kept alongside it. Once the cache grows past `max_entries`, the
+    least recently used entries are evicted until `evict_to` of `max_entries` remain.
+    """
+
+    def __init__(self, path: str, max_entries: int, evict_to: float = 0.9):
+        self.max_entries = max_entries
+        self.evict_to = evict_to
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS responses (id TEXT PRIMARY KEY, raw_text TEXT)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, result TEXT, response_id TEXT, last_used REAL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS results_response_id ON results (response_id)")
+            self.size = self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    @staticmethod
+    def make_key(model: str, prompt: str, comment) -> str:
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        return hashlib.sha256(f"{model}\n{prompt_hash}\n{normalize_comment(comment)}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: list) -> dict:
+        """
+        Returns {key: result} for the keys present in the cache and marks them as recently used.
+        """
+        found = {}
+        now = time.time()
+        with self.lock, self.conn:
+            unique_keys = list(set(keys))
+            # SQLite limits the number of bound parameters per statement
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start:start+500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT key, result FROM results WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, result in rows:
+                    found[key] = json.loads(result)
+                self.conn.executemany(
+                    "UPDATE results SET last_used = ? WHERE key = ?", [(now, key) for key, _ in rows]
+                )
+        return found
+
+    def put_many(self, entries: dict, raw_text: str):
+        """
+        Stores {key: result} pairs parsed from one raw response, evicting old entries if needed.
+        """
+        if not entries:
+            return
+        response_id = hashlib.sha256(raw_text.encode("utf-8")).hexdigest()
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO responses (id, raw_text) VALUES (?, ?)", (response_id, raw_text))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO results (key, result, response_id, last_used) VALUES (?, ?, ?, ?)",
+                [(key, json.dumps(result), response_id, now) for key, result in entries.items()]
+            )
+            self.size += len(entries)
+            if self.size > self.max_entries:
+                # self.size over-counts replaced keys; recount before evicting
+                self.size = self.conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+                excess = self.size - int(self.max_entries * self.evict_to)
+                if self.size > self.max_entries and excess > 0:
+                    evicted = self.conn.execute(
+                        "SELECT key, response_id FROM results ORDER BY last_used LIMIT ?", (excess,)
+                    ).fetchall()
+                    self.conn.executemany("DELETE FROM results WHERE key = ?", [(key,) for key, _ in evicted])
+                    # Only the evicted rows' responses can have become orphans
+                    self.conn.executemany(
+                        "DELETE FROM responses WHERE id = ? AND NOT EXISTS (SELECT 1 FROM results WHERE response_id = ?)",
+                        [(rid, rid) for rid in {rid for _, rid in evicted}]
+                    )
+                    self.size -= len(evicted)
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+def get_response_cache():
+    """
+    Returns the shared on-disk cache, or None if caching is disabled (CACHE_PATH = None).
+    """
+    global _response_cache
+    if CACHE_PATH is None:
+        return None
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(CACHE_PATH, MAX_CACHE_ENTRIES, CACHE_EVICTION_TARGET)
+        return _response_cache
+
+def lookup_cached(comments: list) -> tuple:
+    """
+    Splits comments into those already answered by the cache and those still to classify.
+    Returns ({index: result} for cache hits, [indices still pending]), with 1-based indices.
+    """
+    cache = get_response_cache()
+    if cache is None:
+        return {}, list(range(1, len(comments) + 1))
+    keys = [ResponseCache.make_key(active_model(), classification_prompt(), comment) for comment in comments]
+    found = cache.get_many(keys)
+    cached = {i: found[key] for i, key in enumerate(keys, 1) if key in found}
+    pending = [i for i in range(1, len(comments) + 1) if i not in cached]
+    return cached, pending
+
+def store_cached(comments: list, results: dict, raw_text: str):
+    """
+    Caches the well-formed results parsed directly from one response to a batch of comments.
+    """
+    cache = get_response_cache()
+    if cache is None:
+        return
+    cache.put_many({
+        ResponseCache.make_key(active_model(), classification_prompt(), comments[i - 1]): res
+        for i, res in results.items()
+        if 1 <= i <= len(comments) and res["classification"]
+    }, raw_text)
+
+class ResultJournal:
+    """
+    Append-only JSONL checkpoint of completed rows.
+    Each line holds the 1-based row index, the row's CommentID (when the input has one) and its result.
+    Every batch is flushed and fsynced as it completes, so a crash loses at most the batches in flight.
+    """
+
+    def __init__(self, path: str, comment_ids: list = None, resume: bool = False):
+        self.comment_ids = comment_ids
+        if resume:
+            self.drop_torn_line(path)
+        self.file = open(path, "a" if resume else "w", encoding="utf-8")
+
+    @staticmethod
+    def drop_torn_line(path: str, block_size: int = 65536):
+        """
+        Truncates a journal back to its last complete line, so entries appended on resume
+        do not continue a line a crash left half-written.
+        """
+        if not os.path.exists(path):
+            return
+        with open(path, "rb+") as f:
+            end = f.seek(0, os.SEEK_END)
+            while end > 0:
+                start = max(0, end - block_size)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b"\n")
+                if newline >= 0:
+                    f.truncate(start + newline + 1)
+                    return
+                end = start
+            f.truncate(0)
+
+    @staticmethod
+    def load(path: str, comment_ids: list = None) -> dict:
+        """
+        Reads a journal back into {row index: result}.
+        A torn last line is ignored, as are rows whose CommentID no longer matches the input.
+        """
+        done = {}
+        if not os.path.exists(path):
+            return done
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                row = entry["row"]
+                if comment_ids is not None and (row > len(comment_ids) or str(comment_ids[row - 1]) != entry.get("comment_id")):
+                    continue
+                done[row] = entry["result"]
+        return done
+
+    def append(self, results: dict):
+        for row, result in sorted(results.items()):
+            # Fallbacks are not final; leave them out so a resumed run retries those rows
+            if result.get("fallback"):
+                continue
+            comment_id = str(self.comment_ids[row - 1]) if self.comment_ids is not None else None
+            self.file.write(json.dumps({"row": row, "comment_id": comment_id, "result": result}) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+def find_missing_comments(results: dict, count: int) -> list:
+    """
+    Returns the comment numbers (1..count) that are absent from a parsed response or have no valid category.
+    """
+    return [i for i in range(1, count + 1) if i not in results or not results[i]["classification"]]
+
+def merge_salvaged(results: dict, numbers: list, salvaged: dict):
+    """
+    Maps the results of a resubmitted sub-batch back onto the original comment numbers.
+    A malformed original entry is only replaced when the resubmission did better.
+    """
+    for k, res in salvaged.items():
+        if 1 <= k <= len(numbers) and (res["classification"] or numbers[k - 1] not in results):
+            results[numbers[k - 1]] = res
+
+def split_batches(numbers: list, size: int) -> list:
+    return [numbers[i:i+size] for i in range(0, len(numbers), size)]
+
+def output_tokens_per_comment() -> int:
+    """
+    Output tokens allowed per comment for the current pass; both pack_batches and completion_tokens_for use it.
+    """
+    if GATE_ACTIVE:
+        return GATE_MAX_TOKENS_PER_COMMENT
+    if INCLUDE_REASONING:
+        return MAX_TOKENS_PER_COMMENT
+    return NO_REASONING_MAX_TOKENS_PER_COMMENT
+
+def pack_batches(comments: list, max_items: int = MAX_BATCH_ITEMS, token_budget: int = None) -> list:
+    """
+    Greedily groups consecutive comments into batches that fit the request token budget, by default the
+    REQUEST_TOKEN_BUDGETS entry of active_model(). Each comment is budgeted with the output allowance
+    of output_tokens_per_comment(), which completion_tokens_for() then requests, and that output must
+    also fit within MAX_COMPLETION_TOKENS.
+    Returns a list of (offset, batch) pairs, where offset is the 0-based index of the batch's first comment.
+    A comment too large to share a request is sent on its own.
+    """
+    if token_budget is None:
+        token_budget = REQUEST_TOKEN_BUDGETS.get(active_model(), DEFAULT_REQUEST_TOKEN_BUDGET)
+    prefix_tokens = estimate_tokens(classification_prompt())
+    output_tokens = output_tokens_per_comment()
+    batches = []
+    start = 0
+    used = prefix_tokens
+    for i, comment in enumerate(comments):
+        cost = estimate_tokens(f'\nComment #{i - start + 1}: "{comment}"') + output_tokens
+        full = (
+            i - start >= max_items
+            or used + cost > token_budget
+            or (i - start + 1) * output_tokens > MAX_COMPLETION_TOKENS
+        )
+        if i > start and full:
+            batches.append((start, comments[start:i]))
+            start = i
+            used = prefix_tokens
+            cost = estimate_tokens(f'\nComment #1: "{comment}"') + output_tokens
+        used += cost
+    if start < len(comments):
+        batches.append((start, comments[start:]))
+    return batches
+
+def build_comments_block(comments: list) -> str:
+    """
+    Numbers the comments of a batch; this is the only part of a request that changes between batches.
+    """
+    block = "\n".join(f'Comment #{i}: "{comment}"' for i, comment in enumerate(comments, 1))
+    return block + "\n\nOutput:"
+
+def fallback_results(count: int, reasoning: str) -> dict:
+    """
+    Returns the default classification for each of `count` comments when the model could not be reached.
+    """
+    fallback = {}
+    for i in range(1, count + 1):
+        fallback[i] = {
+            "classification": [{"category": "None", "confidence": 0.50}],
+            "reasoning": reasoning,
+            "fallback": True
+        }
+    return fallback
+
+def completion_tokens_for(count: int) -> int:
+    """
+    Output token allowance for a batch of `count` comments.
+    """
+    return min(MAX_COMPLETION_TOKENS, output_tokens_per_comment() * count)
+
+def drop_unfinished(results: dict, raw_text: str):
+    """
+    Removes the comment whose block ends a truncated response, since its reasoning may be cut off.
+    Blocks followed by another comment header are complete and are kept.
+    """
+    headers = re.findall(r"Comment\s+#(\d+):", raw_text)
+    if headers:
+        results.pop(int(headers[-1]), None)
+
+class StreamCollector:
+    """
+    Accumulates a streamed completion. The text is fed to a BatchResponseParser as it arrives
+    and every comment block it completes is passed to `on_block` straight away.
+    Each backend subclasses it to read its own stream updates and to build a response from them.
+    """
+
+    def __init__(self, on_block=None):
+        self.parser = make_response_parser()
+        self.on_block = on_block
+        self.pieces = []
+        self.finish_reason = None
+        self.usage = None
+
+    def add_text(self, text: str):
+        self.pieces.append(text)
+        completed = self.parser.feed(text)
+        if completed and self.on_block:
+            self.on_block(completed)
+
+    def text(self) -> str:
+        return "".join(self.pieces)
+
+# Backend hooks, installed by the prompt script with use_backend():
+#   build_batch_request(comments) -> the request payload of a batch (chat messages or a prompt string)
+#   request_completion(payload, max_tokens, on_block) -> (raw response text, truncated)
+#   request_completion_async(payload, client, max_tokens, on_block) -> (raw response text, truncated)
+#   open_async_client(max_concurrency) -> async context manager yielding the client for request_completion_async
+build_batch_request = None
+request_completion = None
+request_completion_async = None
+open_async_client = None
+
+def use_backend(build_request, request, request_async, open_client):
+    """
+    Installs a backend's request and transport functions; everything else in this module is backend-independent.
+    """
+    global build_batch_request, request_completion, request_completion_async, open_async_client
+    build_batch_request = build_request
+    request_completion = request
+    request_completion_async = request_async
+    open_async_client = open_client
+
+def classify_batch(comments: list, salvage_rounds: int = MAX_SALVAGE_ROUNDS, on_block=None) -> dict:
+    """
+    Sends a batch of comments to the LLM and returns a dictionary of classification results.
+    Each comment is numbered so that the output can be parsed accordingly.
+    Comments missing or malformed in the response are resubmitted in smaller batches, and a batch
+    rejected for exceeding the context window is split in half, for at most `salvage_rounds` rounds.
+    `on_block` is handed to request_completion for early results from the streamed response.
+    """
+    payload = build_batch_request(comments)
+    try:
+        raw_text, truncated = request_completion(payload, completion_tokens_for(len(comments)), on_block)
+    except Exception as e:
+        if salvage_rounds > 0 and len(comments) > 1 and RETRY_POLICY.is_context_length_error(e):
+            results = {}
+            numbers = list(range(1, len(comments) + 1))
+            for sub in split_batches(numbers, (len(numbers) + 1) // 2):
+                merge_salvaged(results, sub, classify_batch([comments[i - 1] for i in sub], salvage_rounds - 1))
+            return results
+        print("Request failed:", str(e))
+        # Fallback: if all attempts fail, return default classification for each comment
+        return fallback_results(len(comments), "Fallback due to errors.")
+    results = parse_response(raw_text)
+    if truncated:
+        drop_unfinished(results, raw_text)
+    store_cached(comments, results, raw_text)
+
+    missing = find_missing_comments(results, len(comments))
+    if missing and salvage_rounds > 0:
+        # The unfinished tail of a truncated response is re-issued as one batch
+        for sub in split_batches(missing, len(missing) if truncated else SALVAGE_BATCH_SIZE):
+            merge_salvaged(results, sub, classify_batch([comments[i - 1] for i in sub], salvage_rounds - 1))
+    return results
+
+def classify_in_batches(comments: list, batch_size: int = MAX_BATCH_ITEMS, max_workers: int = MAX_CONCURRENT_REQUESTS,
+                        token_budget: int = None, on_results=None) -> dict:
+    """
+    Processes the list of comments in batches to avoid token limits.
+    Batches are packed by pack_batches (at most `batch_size` comments within `token_budget` tokens,
+    by default the active model's budget)
+    and dispatched concurrently through a pool of at most `max_workers` in-flight requests.
+    `on_results`, if given, is called with {index: result} each time a batch completes (e.g. to checkpoint it).
+    Duplicate comments are classified once and the result is fanned out to every copy.
+    With STREAM_RESPONSES, each comment is reported as soon as its block of the streamed response is complete.
+    Returns a dictionary mapping overall comment indices (1-indexed) to classification results.
+    """
+    unique_comments, groups = deduplicate(comments)
+    # Comments already answered by the response cache are never sent
+    overall_results, pending = lookup_cached(unique_comments)
+    if on_results and overall_results:
+        on_results(fan_out(overall_results, groups))
+    pending_comments = [unique_comments[k - 1] for k in pending]
+    emitted = set()
+    emit_lock = threading.Lock()
+
+    def emit(i: int, batch_len: int, batch_results: dict, partial: bool = False):
+        with emit_lock:
+            fresh = {
+                pending[i + j - 1]: res
+                for j, res in batch_results.items()
+                # Ignore comment numbers the model invented outside this batch
+                if 1 <= j <= batch_len and pending[i + j - 1] not in emitted
+                # Malformed streamed blocks are left to the salvage pass
+                and (res["classification"] or not partial)
+            }
+            # A row reported from the stream keeps that result, even if a retry answers it again
+            emitted.update(fresh)
+            overall_results.update(fresh)
+            if on_results and fresh:
+                on_results(fan_out(fresh, groups))
+
+    def stream_handler(i: int, batch_len: int):
+        if not STREAM_RESPONSES:
+            return None
+        return lambda blocks: emit(i, batch_len, blocks, partial=True)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+    try:
+        futures = {
+            executor.submit(contextvars.copy_context().run, classify_batch, batch, MAX_SALVAGE_ROUNDS, stream_handler(i, len(batch))): (i, len(batch))
+            for i, batch in pack_batches(pending_comments, batch_size, token_budget)
+        }
+        for future in as_completed(futures):
+            i, batch_len = futures[future]
+            emit(i, batch_len, future.result())
+    finally:
+        # On Ctrl-C, drop the queued batches instead of running all of them before exiting
+        executor.shutdown(wait=True, cancel_futures=True)
+    return fan_out(overall_results, groups)
+
+
+async def classify_batch_async(comments: list, client, salvage_rounds: int = MAX_SALVAGE_ROUNDS, on_block=None) -> dict:
+    """
+    Async counterpart of classify_batch; `client` is the one opened by open_async_client.
+    The request is awaited instead of blocking a thread, so many batches can share one event loop.
+    Salvages missing comments and over-long batches the same way as classify_batch, one sub-batch after another,
+    so a batch never has more than the one request in flight that its concurrency slot allows.
+    """
+    payload = build_batch_request(comments)
+    try:
+        raw_text, truncated = await request_completion_async(payload, client, completion_tokens_for(len(comments)), on_block)
+    except Exception as e:
+        if salvage_rounds > 0 and len(comments) > 1 and RETRY_POLICY.is_context_length_error(e):
+            numbers = list(range(1, len(comments) + 1))
+            sub_batches = split_batches(numbers, (len(numbers) + 1) // 2)
+        else:
+            print("Request failed:", str(e))
+            return fallback_results(len(comments), "Fallback due to errors.")
+        results = {}
+    else:
+        results = parse_response(raw_text)
+        if truncated:
+            drop_unfinished(results, raw_text)
+        store_cached(comments, results, raw_text)
+        missing = find_missing_comments(results, len(comments))
+        sub_batches = split_batches(missing, len(missing) if truncated else SALVAGE_BATCH_SIZE) if salvage_rounds > 0 and missing else []
+
+    for sub in sub_batches:
+        merge_salvaged(results, sub, await classify_batch_async([comments[i - 1] for i in sub], client, salvage_rounds - 1))
+    return results
+
+async def classify_in_batches_async(comments: list, batch_size: int = MAX_BATCH_ITEMS, max_concurrency: int = MAX_ASYNC_REQUESTS,
+                                    token_budget: int = None, on_results=None) -> dict:
+    """
+    Async counterpart of classify_in_batches.
+    All batches are scheduled on the event loop and a semaphore keeps at most `max_concurrency` requests in flight.
+    Duplicate comments are classified once and the result is fanned out to every copy.
+    Returns a dictionary mapping overall comment indices (1-indexed) to classification results.
+    """
+    unique_comments, groups = deduplicate(comments)
+    overall_results, pending = lookup_cached(unique_comments)
+    if on_results and overall_results:
+        on_results(fan_out(overall_results, groups))
+    pending_comments = [unique_comments[k - 1] for k in pending]
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    emitted = set()
+
+    def emit(i: int, batch_len: int, batch_results: dict, partial: bool = False):
+        fresh = {
+            pending[i + j - 1]: res
+            for j, res in batch_results.items()
+            if 1 <= j <= batch_len and pending[i + j - 1] not in emitted
+            and (res["classification"] or not partial)
+        }
+        emitted.update(fresh)
+        overall_results.update(fresh)
+        if on_results and fresh:
+            on_results(fan_out(fresh, groups))
+
+    def stream_handler(i: int, batch_len: int):
+        if not STREAM_RESPONSES:
+            return None
+        return lambda blocks: emit(i, batch_len, blocks, partial=True)
+
+    async with open_async_client(max_concurrency) as client:
+        async def run_batch(i: int, batch: list):
+            async with semaphore:
+                return i, len(batch), await classify_batch_async(
+                    batch, client, MAX_SALVAGE_ROUNDS, stream_handler(i, len(batch)))
+
+        tasks = [run_batch(i, batch) for i, batch in pack_batches(pending_comments, batch_size, token_budget)]
+        for coro in asyncio.as_completed(tasks):
+            i, batch_len, batch_results = await coro
+            emit(i, batch_len, batch_results)
+    return fan_out(overall_results, groups)
+
+def build_output_frame(df: pd.DataFrame, results: dict) -> pd.DataFrame:
+    """
+    Adds the per-category confidence columns, the classification and the reasoning to the input rows.
+    `results` maps 1-based positions within `df` to classification results.
+    Confidences are written into one dense float32 matrix (row x CATEGORY_INDEX) and the new columns
+    are attached to the frame in a single operation instead of one cell at a time.
+    With KEYWORD_LEXICON_PATH, the matched lexicon families are added as a keyword_families column.
+    """
+    df = df.reset_index(drop=True)
+    confidences = np.zeros((len(df), len(CATEGORIES)), dtype=np.float32)
+    classifications_list = []
+    reasonings_list = []
+
+    for row in range(len(df)):
+        result = results.get(row + 1, {"classification": [{"category": "None", "confidence": 0.50}],
+                                       "reasoning": "No output"})
+        current_categories = []
+        for entry in result["classification"]:
+            cat = entry["category"]
+            col = CATEGORY_INDEX.get(cat)
+            if col is not None:
+                confidences[row, col] = entry["confidence"]
+            current_categories.append(cat)
+        # If no categories were extracted, force "None"
+        classifications_list.append(", ".join(current_categories) if current_categories else "None")
+        reasonings_list.append(result["reasoning"])
+
+    confidence_columns = [f"{cat}_confidence" for cat in CATEGORIES]
+    assembled = pd.DataFrame(confidences, columns=confidence_columns)
+    assembled["classification"] = classifications_list
+    assembled["reasoning"] = reasonings_list
+    if KEYWORD_LEXICON_PATH:
+        assembled["keyword_families"] = [";".join(sorted(found)) or KEYWORD_NO_MATCH_FAMILY
+                                         for found in keyword_families(df["comment"].tolist())]
+    # Re-classified inputs already carry these columns; replace them rather than duplicating
+    return pd.concat([df.drop(columns=list(assembled.columns), errors="ignore"), assembled], axis=1)
+
+def classify_comments(comments: list, on_results=None, batch_size: int = None) -> dict:
+    """
+    Classifies comments with the async or the thread-pool pipeline, depending on USE_ASYNC.
+    `batch_size` overrides MAX_BATCH_ITEMS as the most comments per request.
+    """
+    batch_size = batch_size or MAX_BATCH_ITEMS
+    if USE_ASYNC:
+        return asyncio.run(classify_in_batches_async(comments, batch_size, on_results=on_results))
+    return classify_in_batches(comments, batch_size, on_results=on_results)
+
+def gate_comments(comments: list) -> tuple:
+    """
+    First stage of a two-stage run: screens the comments with GATE_PROMPT in batches of up to GATE_MAX_BATCH_ITEMS.
+    Comments answered "Benign" with at least GATE_MIN_CONFIDENCE are final as "None"; everything else,
+    including comments the gate failed to answer, goes on to the fine-grained prompt.
+    Returns ({index: result} for cleared comments, [indices still to classify]), with 1-based indices.
+    """
+    global GATE_ACTIVE
+    GATE_ACTIVE = True
+    # In a cascade the binary screen runs on the cheapest model
+    model_token = ACTIVE_MODEL.set(CASCADE_MODELS[0] if USE_CASCADE else None)
+    try:
+        verdicts = classify_comments(comments, batch_size=GATE_MAX_BATCH_ITEMS)
+    finally:
+        GATE_ACTIVE = False
+        ACTIVE_MODEL.reset(model_token)
+    cleared = {}
+    for idx, res in verdicts.items():
+        labels = res["classification"]
+        if (not res.get("fallback") and len(labels) == 1 and labels[0]["category"] == "None"
+                and labels[0]["confidence"] >= GATE_MIN_CONFIDENCE):
+            cleared[idx] = {"classification": labels, "reasoning": GATE_CLEARED_REASONING}
+    forwarded = [idx for idx in range(1, len(comments) + 1) if idx not in cleared]
+    return cleared, forwarded
+
+_local_model = None
+
+def get_local_model():
+    """
+    Loads the artifact at LOCAL_MODEL_PATH once: either {"pipeline": fitted scikit-learn pipeline, ...} or a distilled
+    {"vectorizer", "weights", "intercepts", ...} linear model, both with "categories" in CATEGORIES order.
+    Unpickling runs code, so only point LOCAL_MODEL_PATH at artifacts you trained yourself.
+    """
+    global _local_model
+    if _local_model is None:
+        with open(LOCAL_MODEL_PATH, "rb") as f:
+            artifact = pickle.load(f)
+        if artifact["categories"] != CATEGORIES:
+            raise ValueError(f"{LOCAL_MODEL_PATH} was trained for different categories")
+        _local_model = artifact
+    return _local_model
+
+def local_model_probabilities(comments: list) -> np.ndarray:
+    """
+    Scores comments with the local classifier: a (comments x CATEGORIES) array of per-category probabilities.
+    """
+    model = get_local_model()
+    texts = [str(comment) for comment in comments]
+    if "pipeline" in model:
+        return model["pipeline"].predict_proba(texts)
+    # Distilled model: one independent logistic output per category
+    scores = model["vectorizer"].transform(texts) @ model["weights"] + model["intercepts"]
+    return 1.0 / (1.0 + np.exp(-scores))
+
+def local_model_comments(comments: list) -> tuple:
+    """
+    First stage with the local classifier, which scores every comment on CPU.
+    A comment is decided locally as "None" when P(None) >= LOCAL_MODEL_THRESHOLD, or with its harmful
+    categories when P(None) <= 1 - LOCAL_MODEL_THRESHOLD and at least one category reaches the threshold.
+    Returns ({index: result} for decided comments, [indices still to classify]), with 1-based indices.
+    """
+    probabilities = local_model_probabilities(comments)
+    decided = {}
+    for idx, p in enumerate(probabilities, 1):
+        if p[0] >= LOCAL_MODEL_THRESHOLD:
+            labels = [{"category": "None", "confidence": round(float(p[0]), 2)}]
+        elif p[0] <= 1 - LOCAL_MODEL_THRESHOLD and p[1:].max() >= LOCAL_MODEL_THRESHOLD:
+            labels = [{"category": CATEGORIES[i], "confidence": round(float(p[i]), 2)}
+                      for i in range(1, len(CATEGORIES)) if p[i] >= LOCAL_MODEL_THRESHOLD]
+        else:
+            continue
+        decided[idx] = {"classification": labels, "reasoning": LOCAL_MODEL_REASONING}
+    forwarded = [idx for idx in range(1, len(comments) + 1) if idx not in decided]
+    return decided, forwarded
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick automaton over the terms of a {family: [terms]} lexicon. families() finds every term in
+    one pass over the text, so matching costs the same however many terms the lexicon has.
+    Terms only match as whole words (or phrases), case-insensitively.
+    """
+
+    def __init__(self, lexicon: dict):
+        # Trie of the terms: goto[state] maps a character to the next state, out[state] lists the
+        # (term length, family) of every term ending there
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for family, terms in lexicon.items():
+            for term in terms:
+                term = term.lower()
+                state = 0
+                for char in term:
+                    if char not in self.goto[state]:
+                        self.goto[state][char] = len(self.goto)
+                        self.goto.append({})
+                        self.fail.append(0)
+                        self.out.append([])
+                    state = self.goto[state][char]
+                self.out[state].append((len(term), family))
+        # Breadth-first, each state falls back to the longest proper suffix that is also a trie path
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def families(self, text: str) -> set:
+        """
+        Returns the families of all lexicon terms that occur in `text` as whole words.
+        """
+        text = text.lower()
+        found = set()
+        state = 0
+        for end, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for length, family in self.out[state]:
+                start = end - length + 1
+                if ((start == 0 or not text[start - 1].isalnum())
+                        and (end + 1 == len(text) or not text[end + 1].isalnum())):
+                    found.add(family)
+        return found
+
+_keyword_automaton = None
+
+def get_keyword_automaton() -> KeywordAutomaton:
+    """
+    Builds the automaton for the lexicon at KEYWORD_LEXICON_PATH once.
+    """
+    global _keyword_automaton
+    if _keyword_automaton is None:
+        with open(KEYWORD_LEXICON_PATH, "r", encoding="utf-8") as f:
+            lexicon = json.load(f)
+        if not isinstance(lexicon, dict) or not all(isinstance(terms, list) for terms in lexicon.values()):
+            raise ValueError(f"{KEYWORD_LEXICON_PATH} should map keyword families to lists of terms")
+        _keyword_automaton = KeywordAutomaton(lexicon)
+    return _keyword_automaton
+
+def keyword_families(comments: list) -> list:
+    """
+    The set of lexicon families each comment matches (empty for no match).
+    """
+    automaton = get_keyword_automaton()
+    return [automaton.families(str(comment)) for comment in comments]
+
+def keyword_prefilter_comments(comments: list) -> tuple:
+    """
+    First stage with the keyword lexicon, on CPU. Comments that match a term go on unchanged. Comments that
+    match none are final as "None" with KEYWORD_NO_MATCH_ACTION "skip"; with "gate" they are screened by the
+    gate prompt and only go on if it does not clear them (with USE_GATE the gate stage screens them anyway).
+    Returns ({index: result} for decided comments, [indices still to classify]), with 1-based indices.
+    """
+    unmatched = [idx for idx, found in enumerate(keyword_families(comments), 1) if not found]
+    if KEYWORD_NO_MATCH_ACTION == "skip":
+        decided = {idx: {"classification": [{"category": "None", "confidence": KEYWORD_SKIP_CONFIDENCE}],
+                         "reasoning": KEYWORD_SKIP_REASONING} for idx in unmatched}
+    elif USE_GATE or not unmatched:
+        decided = {}
+    else:
+        cleared, _ = gate_comments([comments[idx - 1] for idx in unmatched])
+        decided = {unmatched[k - 1]: res for k, res in cleared.items()}
+    forwarded = [idx for idx in range(1, len(comments) + 1) if idx not in decided]
+    return decided, forwarded
+
+def needs_escalation(result: dict) -> bool:
+    """
+    True when a cascade tier's result should be re-classified by the next model: no usable labels (or a fallback),
+    a top label below its CASCADE_THRESHOLDS confidence, or any harmful label with CASCADE_ESCALATE_FLAGGED.
+    """
+    labels = result["classification"]
+    if not labels or result.get("fallback"):
+        return True
+    if CASCADE_ESCALATE_FLAGGED and any(entry["category"] != "None" for entry in labels):
+        return True
+    top = max(labels, key=lambda entry: entry["confidence"])
+    return top["confidence"] < CASCADE_THRESHOLDS.get(top["category"], CASCADE_DEFAULT_THRESHOLD)
+
+def classify_cascade(comments: list, on_results=None) -> dict:
+    """
+    Classifies comments with each model of CASCADE_MODELS in turn, cheapest first. Every tier sees only the
+    comments the previous one escalated (needs_escalation), and the last tier's results are final.
+    Results keep the usual schema; `on_results` receives each comment once, when its result is final.
+    """
+    results = {}
+    pending = list(range(1, len(comments) + 1))
+    for tier, model in enumerate(CASCADE_MODELS):
+        last = tier == len(CASCADE_MODELS) - 1
+
+        def report(batch_results: dict, pending=pending, last=last):
+            final = {pending[k - 1]: res for k, res in batch_results.items() if last or not needs_escalation(res)}
+            if final:
+                on_results(final)
+
+        model_token = ACTIVE_MODEL.set(model)
+        try:
+            tier_results = classify_comments([comments[idx - 1] for idx in pending], report if on_results else None)
+        finally:
+            ACTIVE_MODEL.reset(model_token)
+        escalated = []
+        for k in range(1, len(pending) + 1):
+            res = tier_results.get(k)
+            # A comment the tier returned no result for failed on it, and goes on like an uncertain one
+            if not last and (res is None or needs_escalation(res)):
+                escalated.append(pending[k - 1])
+            elif res is not None:
+                results[pending[k - 1]] = res
+        print(f"Cascade {model}: {len(pending) - len(escalated)} final, {len(escalated)} escalated")
+        pending = escalated
+        if not pending:
+            break
+    return results
+
+def ensemble_agrees(first: dict, second: dict) -> bool:
+    """
+    True when two ensemble members answered a comment with the same, non-empty set of labels.
+    """
+    labels = {entry["category"] for entry in first["classification"]}
+    return (not first.get("fallback") and not second.get("fallback") and bool(labels)
+            and labels == {entry["category"] for entry in second["classification"]})
+
+def merge_votes(votes: list) -> dict:
+    """
+    Combines the ensemble members' results for one comment. A category is kept when most of the members that
+    answered name it, with the mean of their confidences (0 for a member that left it out). Members that fell
+    back do not vote; without a majority the last (tie-breaker) answer is kept as it is.
+    """
+    valid = [res for res in votes if not res.get("fallback")]
+    if not valid:
+        return votes[-1]
+    counts, totals = {}, {}
+    for res in valid:
+        for cat, confidence in {entry["category"]: entry["confidence"] for entry in res["classification"]}.items():
+            counts[cat] = counts.get(cat, 0) + 1
+            totals[cat] = totals.get(cat, 0.0) + confidence
+    chosen = [cat for cat, count in counts.items() if count * 2 > len(valid)]
+    if len(chosen) > 1 and "None" in chosen:
+        chosen.remove("None")
+    if not chosen:
+        return valid[-1]
+    # Keep the reasoning of a member that gave exactly the chosen labels
+    reasoning = next((res["reasoning"] for res in valid
+                      if {entry["category"] for entry in res["classification"]} == set(chosen)), valid[-1]["reasoning"])
+    return {
+        "classification": [{"category": cat, "confidence": round(totals[cat] / len(valid), 2)} for cat in chosen],
+        "reasoning": reasoning
+    }
+
+def classify_ensemble(comments: list, on_results=None) -> dict:
+    """
+    Classifies every comment with the first two ENSEMBLE_MODELS at once, each in its own thread and pipeline.
+    A comment both answer with the same labels is final as soon as the second answer arrives; the disputed
+    ones, including those a member returned no result for, are classified by the third model and settled by
+    merge_votes over the members that answered.
+    Results keep the usual schema; `on_results` receives each comment once, when its result is final.
+    """
+    first, second, tie_breaker = ENSEMBLE_MODELS[:3]
+    answers = ({}, {})
+    results = {}
+    lock = threading.Lock()
+
+    def member_votes(k: int) -> list:
+        # A member whose salvage ran out has no result for the comment and does not vote
+        return [answers[voter][k] for voter in (0, 1) if k in answers[voter]]
+
+    def collect(member: int, batch_results: dict):
+        final = {}
+        with lock:
+            answers[member].update(batch_results)
+            for k in batch_results:
+                votes = member_votes(k)
+                if k not in results and len(votes) == 2 and ensemble_agrees(*votes):
+                    final[k] = merge_votes(votes)
+            results.update(final)
+            # Both member threads report here; hold the lock so on_results (e.g. the journal) is never re-entered
+            if on_results and final:
+                on_results(final)
+
+    def run_member(member: int, model: str):
+        ACTIVE_MODEL.set(model)
+        return classify_comments(comments, lambda batch_results: collect(member, batch_results))
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, run_member, member, model)
+                   for member, model in enumerate((first, second))]
+        for member, future in enumerate(futures):
+            collect(member, future.result())
+
+    disputed = [k for k in range(1, len(comments) + 1) if k not in results]
+    print(f"Ensemble {first} + {second}: {len(results)} agreed, {len(disputed)} sent to {tie_breaker}")
+    if not disputed:
+        return results
+
+    def settle(batch_results: dict) -> dict:
+        return {disputed[j - 1]: merge_votes(member_votes(disputed[j - 1]) + [res])
+                for j, res in batch_results.items()}
+
+    model_token = ACTIVE_MODEL.set(tie_breaker)
+    try:
+        tie_results = classify_comments([comments[k - 1] for k in disputed],
+                                        (lambda batch_results: on_results(settle(batch_results))) if on_results else None)
+    finally:
+        ACTIVE_MODEL.reset(model_token)
+    results.update(settle(tie_results))
+    # Disputed comments the tie-breaker returned nothing for keep the vote of the members that answered
+    unsettled = {k: merge_votes(member_votes(k)) for k in disputed if k not in results and member_votes(k)}
+    results.update(unsettled)
+    if on_results and unsettled:
+        on_results(unsettled)
+    return results
+
+def final_stage():
+    """
+    The classifier the fine-grained prompt runs through: classify_ensemble, classify_cascade or classify_comments.
+    """
+    if USE_ENSEMBLE:
+        return classify_ensemble
+    if USE_CASCADE:
+        return classify_cascade
+    return classify_comments
+
+def classify_in_stages(comments: list, on_results=None) -> dict:
+    """
+    Classifies comments through the enabled first stages before the fine-grained prompt: the keyword prefilter
+    (KEYWORD_LEXICON_PATH) skips or down-routes comments without a lexicon term, the local classifier
+    (LOCAL_MODEL_PATH) decides the comments it is confident about, the gate prompt (USE_GATE) clears the benign
+    majority of the rest, and only the remaining comments pay for the full classification prompt, through
+    classify_ensemble or classify_cascade when USE_ENSEMBLE or USE_CASCADE is set.
+    `on_results` receives the results of every stage.
+    """
+    classify = final_stage()
+    stages = []
+    if KEYWORD_LEXICON_PATH:
+        stages.append(("Keyword prefilter", keyword_prefilter_comments))
+    if LOCAL_MODEL_PATH:
+        stages.append(("Local classifier", local_model_comments))
+    if USE_GATE:
+        stages.append(("Gate", gate_comments))
+    if not stages:
+        return classify(comments, on_results)
+
+    results = {}
+    forwarded = list(range(1, len(comments) + 1))
+    for name, stage in stages:
+        if not forwarded:
+            return results
+        decided, rest = stage([comments[idx - 1] for idx in forwarded])
+        decided = {forwarded[k - 1]: res for k, res in decided.items()}
+        forwarded = [forwarded[k - 1] for k in rest]
+        print(f"{name} decided {len(decided)} comments; {len(forwarded)} go on")
+        results.update(decided)
+        if on_results and decided:
+            on_results(decided)
+    if not forwarded:
+        return results
+
+    def forward(batch_results: dict):
+        on_results({forwarded[k - 1]: res for k, res in batch_results.items()})
+
+    detailed = classify([comments[idx - 1] for idx in forwarded], forward if on_results else None)
+    results.update({forwarded[k - 1]: res for k, res in detailed.items()})
+    return results
+
+def explain_flagged(comments: list, results: dict, on_results=None) -> dict:
+    """
+    Second pass of a reasoning-free run: the comments flagged with a harmful category (and not yet explained,
+    including those labelled by the local classifier) are classified again with reasoning, through the same
+    ensemble or cascade as the first pass, and take that result. Only these rows pay for reasoning tokens.
+    `results` maps 1-based indices into `comments`; `on_results` receives the updated rows.
+    """
+    global INCLUDE_REASONING
+    flagged = [
+        idx for idx, res in sorted(results.items())
+        if res["reasoning"] in ("", LOCAL_MODEL_REASONING) and any(entry["category"] != "None" for entry in res["classification"])
+    ]
+    if not flagged:
+        return results
+    print(f"Explaining {len(flagged)} flagged comments")
+    INCLUDE_REASONING = True
+    try:
+        explained = final_stage()([comments[idx - 1] for idx in flagged])
+    finally:
+        INCLUDE_REASONING = False
+    updated = {
+        flagged[k - 1]: res for k, res in explained.items()
+        if res["classification"] and not res.get("fallback")
+    }
+    results.update(updated)
+    if on_results and updated:
+        on_results(updated)
+    return results
+
+def count_csv_rows(path: str) -> int:
+    """
+    Counts the data rows of a CSV without loading it into memory.
+    """
+    return sum(len(chunk) for chunk in pd.read_csv(path, usecols=[0], chunksize=100000))
+
+def run_streaming(args):
+    """
+    Classifies the input in chunks of `args.chunksize` rows and appends each classified chunk to the output,
+    so memory stays bounded by the chunk size. The output file itself is the checkpoint: with --resume,
+    rows already written are skipped in the input and new chunks are appended.
+    """
+    done = count_csv_rows(args.output) if args.resume and os.path.exists(args.output) else 0
+    if done:
+        print(f"Resuming: {done} rows already in {args.output}")
+    write_header = done == 0
+    # A callable, not range(): pandas would turn a range into a set of `done` row numbers
+    reader = pd.read_csv(args.input, chunksize=args.chunksize, skiprows=lambda i: 0 < i <= done)
+    for chunk in reader:
+        comments = chunk["comment"].tolist()
+        results = classify_in_stages(comments)
+        if EXPLAIN_FLAGGED and not INCLUDE_REASONING:
+            results = explain_flagged(comments, results)
+        # Serialise the whole chunk first so a crash cannot leave half of it on disk
+        text = build_output_frame(chunk, results).to_csv(index=False, header=write_header)
+        with open(args.output, "w" if write_header else "a", encoding="utf-8", newline="") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        write_header = False
+        done += len(chunk)
+        print(f"Classified {done} rows")
+    print("Usage:", USAGE_STATS.summary())
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify sexist and misogynistic content in GitHub comments.")
+    parser.add_argument("--input", default="input-file", help="CSV file with a 'comment' column")
+    parser.add_argument("--output", default="output-file", help="CSV file to write the classified rows to")
+    parser.add_argument("--journal", help="JSONL checkpoint of completed rows (default: <output>.journal.jsonl)")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip rows already in the journal and rebuild the output from it")
+    parser.add_argument("--chunksize", type=int,
+                        help="stream the input in chunks of this many rows and append each classified chunk to the output")
+    parser.add_argument("--no-reasoning", action="store_true",
+                        help="classify without per-comment reasoning (bulk triage, far fewer output tokens)")
+    parser.add_argument("--explain-flagged", action="store_true",
+                        help="with --no-reasoning, re-run the comments flagged as harmful with reasoning")
+    parser.add_argument("--gate", action="store_true",
+                        help="screen comments with a short harmful/benign prompt first and classify only the rest in full")
+    parser.add_argument("--local-model",
+                        help="pickled local classifier; comments it is confident about are not sent to the LLM")
+    parser.add_argument("--local-threshold", type=float,
+                        help="confidence the local classifier needs to decide a comment on its own (default: 0.9)")
+    parser.add_argument("--cascade", action="store_true",
+                        help="classify with the cheapest model first and escalate uncertain or flagged comments")
+    parser.add_argument("--cascade-models",
+                        help="comma-separated models of the cascade, cheapest first (default: CASCADE_MODELS)")
+    parser.add_argument("--ensemble", action="store_true",
+                        help="classify with two models in parallel and send their disagreements to a third")
+    parser.add_argument("--ensemble-models",
+                        help="comma-separated models of the ensemble, the tie-breaker last (default: ENSEMBLE_MODELS)")
+    parser.add_argument("--keyword-lexicon",
+                        help="JSON lexicon of keyword families; comments matching no term are skipped or down-routed")
+    parser.add_argument("--no-keyword", choices=["skip", "gate"],
+                        help="with --keyword-lexicon, only screen comments without a keyword with the gate prompt "
+                             "(gate, the default) or label them 'None' (skip)")
+    args = parser.parse_args()
+    global INCLUDE_REASONING, EXPLAIN_FLAGGED, USE_GATE, LOCAL_MODEL_PATH, LOCAL_MODEL_THRESHOLD, USE_CASCADE, CASCADE_MODELS
+    global USE_ENSEMBLE, ENSEMBLE_MODELS, KEYWORD_LEXICON_PATH, KEYWORD_NO_MATCH_ACTION
+    if args.no_reasoning:
+        INCLUDE_REASONING = False
+    if args.explain_flagged:
+        EXPLAIN_FLAGGED = True
+    if args.gate:
+        USE_GATE = True
+    if args.local_model:
+        LOCAL_MODEL_PATH = args.local_model
+    if args.local_threshold is not None:
+        LOCAL_MODEL_THRESHOLD = args.local_threshold
+    if args.cascade or args.cascade_models:
+        USE_CASCADE = True
+    if args.cascade_models:
+        CASCADE_MODELS = [model.strip() for model in args.cascade_models.split(",") if model.strip()]
+    if args.ensemble or args.ensemble_models:
+        USE_ENSEMBLE = True
+    if args.ensemble_models:
+        ENSEMBLE_MODELS = [model.strip() for model in args.ensemble_models.split(",") if model.strip()]
+        if len(ENSEMBLE_MODELS) != 3:
+            parser.error("--ensemble-models takes exactly three models: two voters and the tie-breaker")
+    if USE_ENSEMBLE and USE_CASCADE:
+        parser.error("--ensemble and --cascade cannot be combined")
+    if args.keyword_lexicon:
+        KEYWORD_LEXICON_PATH = args.keyword_lexicon
+    if args.no_keyword:
+        KEYWORD_NO_MATCH_ACTION = args.no_keyword
+    if args.chunksize:
+        run_streaming(args)
+        return
+    journal_path = args.journal or f"{args.output}.journal.jsonl"
+
+    # Load comments from CSV
+    df = pd.read_csv(args.input)
+    comments = df["comment"].tolist()
+    comment_ids = df["CommentID"].tolist() if "CommentID" in df.columns else None
+
+    results = ResultJournal.load(journal_path, comment_ids) if args.resume else {}
+    pending = [idx for idx in range(1, len(comments) + 1) if idx not in results]
+    if args.resume:
+        print(f"Resuming: {len(results)} rows already in {journal_path}, {len(pending)} to classify")
+
+    # Each completed batch is checkpointed under its original row index
+    journal = ResultJournal(journal_path, comment_ids, resume=args.resume)
+    def checkpoint(batch_results: dict):
+        journal.append({pending[k - 1]: res for k, res in batch_results.items()})
+
+    pending_comments = [comments[idx - 1] for idx in pending]
+    try:
+        new_results = classify_in_stages(pending_comments, on_results=checkpoint)
+        results.update({pending[k - 1]: res for k, res in new_results.items()})
+        if EXPLAIN_FLAGGED and not INCLUDE_REASONING:
+            results = explain_flagged(comments, results, on_results=journal.append)
+    finally:
+        journal.close()
+    
+    df = build_output_frame(df, results)
+    df.to_csv(args.output, index=False)
+    print("Usage:", USAGE_STATS.summary())
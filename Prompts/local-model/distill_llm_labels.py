@@ -0,0 +1,279 @@
+"""
+Distils the LLM labels accumulated under results/ into a compact local multi-label model.
+
+Every saved run (results/fewshot/{gpt,llama,mistral}/*.csv by default) holds one <category>_confidence
+column per category ("Neutral_confidence" / "None_confidence" for None). Rows that fell back ("No output",
+"Fallback ...") or carry no confidence are dropped, as are runs where most rows failed. The remaining
+confidences are averaged per comment (matched by whitespace-normalised text) into soft labels, and one
+logistic regression per category is fitted on TF-IDF features against those soft labels (each comment
+is a positive with weight p and a negative with weight 1 - p, i.e. cross-entropy on the soft label).
+
+The artifact is a TF-IDF vectorizer plus a (features x categories) weight matrix, loadable by the prompt
+scripts' --local-model option like the supervised model from train_local_classifier.py. Comments the
+distilled model is confident about need no API call; the uncertain ones, where the teacher runs tend to
+disagree, are forwarded to the LLM.
+
+The report gives 5-fold out-of-fold agreement with the teacher consensus and with the gold labels of
+Datasets/final_dataset.csv, the share of comments decided locally per threshold, and comments/sec on a
+single CPU core:
+  python distill_llm_labels.py
+  python distill_llm_labels.py --results "results/fewshot/gpt/*.csv" --no-char-ngrams
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import pickle
+import argparse
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import sklearn
+from threadpoolctl import threadpool_limits
+from sklearn.pipeline import FeatureUnion
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import KFold
+from sklearn.metrics import matthews_corrcoef
+
+from train_local_classifier import (CATEGORIES, REPO_ROOT, DEFAULT_DATASET, THRESHOLDS, canonical_category,
+                                    normalize_comment, local_decisions)
+
+DEFAULT_RESULTS = [os.path.join(REPO_ROOT, "results", "fewshot", model, "*.csv") for model in ("gpt", "llama", "mistral")]
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "distilled_classifier.pkl")
+DEFAULT_REPORT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "distilled_classifier_report.json")
+
+# Earlier prompts named the Dismissing category differently
+FORMER_CATEGORY_NAMES = {"Victim blaming": "Dismissing", "Blaming": "Dismissing", "Deflection": "Dismissing"}
+
+# Runs with fewer usable rows than this fraction are left out entirely
+MIN_VALID_FRACTION = 0.5
+# A comment is "disputed" when the teachers' average None confidence falls between these bounds
+DISPUTED_RANGE = (0.2, 0.8)
+
+
+def load_run(path: str):
+    """
+    Returns (normalised comments, confidences as rows x CATEGORIES) for the usable rows of one saved run,
+    or None if the run has no confidence columns or mostly failed.
+    """
+    df = pd.read_csv(path)
+    columns = {}
+    for column in df.columns:
+        if column.endswith("_confidence"):
+            name = column[:-len("_confidence")]
+            category = FORMER_CATEGORY_NAMES.get(name) or canonical_category(name)
+            if category:
+                columns[category] = column
+    if "comment" not in df.columns or len(columns) != len(CATEGORIES):
+        return None
+    confidences = df[[columns[cat] for cat in CATEGORIES]].apply(pd.to_numeric, errors="coerce").fillna(0.0)
+    confidences = confidences.to_numpy(dtype=np.float64).clip(0.0, 1.0)
+    failed = df["reasoning"].astype(str).str.startswith(("No output", "Fallback")).to_numpy() if "reasoning" in df.columns \
+        else np.zeros(len(df), dtype=bool)
+    usable = ~failed & (confidences.sum(axis=1) > 0) & df["comment"].notna().to_numpy()
+    if usable.mean() < MIN_VALID_FRACTION:
+        return None
+    comments = [normalize_comment(comment) for comment in df.loc[usable, "comment"]]
+    return comments, confidences[usable]
+
+
+def soft_labels(paths: list) -> tuple:
+    """
+    Averages the confidences of every usable run per comment.
+    Returns (comments, soft labels as comments x CATEGORIES, number of runs per comment, runs used).
+    """
+    sums = {}
+    counts = {}
+    used = []
+    for path in paths:
+        run = load_run(path)
+        if run is None:
+            print(f"Skipping {os.path.relpath(path, REPO_ROOT)}", file=sys.stderr)
+            continue
+        used.append(os.path.relpath(path, REPO_ROOT))
+        for comment, row in zip(*run):
+            if comment in sums:
+                sums[comment] += row
+                counts[comment] += 1
+            else:
+                sums[comment] = row.copy()
+                counts[comment] = 1
+    comments = sorted(sums)
+    labels = np.array([sums[comment] / counts[comment] for comment in comments])
+    return comments, labels, np.array([counts[comment] for comment in comments]), used
+
+
+def build_vectorizer(char_ngrams: bool):
+    words = TfidfVectorizer(lowercase=True, ngram_range=(1, 2), min_df=2, sublinear_tf=True)
+    if not char_ngrams:
+        return words
+    chars = TfidfVectorizer(lowercase=True, analyzer="char_wb", ngram_range=(3, 5), min_df=2,
+                            sublinear_tf=True, max_features=30000)
+    return FeatureUnion([("words", words), ("chars", chars)])
+
+
+def fit_soft(features, labels: np.ndarray, C: float) -> tuple:
+    """
+    One logistic regression per category on soft labels: every row appears once as a positive weighted by
+    its soft label and once as a negative weighted by the complement.
+    Returns (weights as features x categories, intercepts) in float32.
+    """
+    rows = features.shape[0]
+    stacked = sp.vstack([features, features]).tocsr()
+    targets = np.r_[np.ones(rows), np.zeros(rows)]
+    weights = np.zeros((features.shape[1], labels.shape[1]), dtype=np.float32)
+    intercepts = np.zeros(labels.shape[1], dtype=np.float32)
+    for j in range(labels.shape[1]):
+        # A tiny floor keeps both classes present for categories no teacher ever used
+        sample_weight = np.r_[labels[:, j], 1.0 - labels[:, j]] + 1e-6
+        model = LogisticRegression(C=C, max_iter=2000).fit(stacked, targets, sample_weight=sample_weight)
+        weights[:, j] = model.coef_[0]
+        intercepts[j] = model.intercept_[0]
+    return weights, intercepts
+
+
+def predict(vectorizer, weights: np.ndarray, intercepts: np.ndarray, comments: list) -> np.ndarray:
+    """
+    Per-category probabilities, the same computation the prompt scripts run for a distilled artifact.
+    """
+    scores = vectorizer.transform(comments) @ weights + intercepts
+    return 1.0 / (1.0 + np.exp(-scores))
+
+
+def agreement(probabilities: np.ndarray, labels: np.ndarray, rows=None) -> dict:
+    """
+    Binary (harmful when P(None) < 0.5) and top-category agreement with the teacher consensus.
+    """
+    rows = slice(None) if rows is None else rows
+    p, y = probabilities[rows], labels[rows]
+    if not len(p):
+        return {"binary": None, "top_category": None}
+    return {
+        "binary": round(float(np.mean((p[:, 0] < 0.5) == (y[:, 0] < 0.5))), 4),
+        "top_category": round(float(np.mean(p.argmax(axis=1) == y.argmax(axis=1))), 4),
+    }
+
+
+def benchmark_single_core(vectorizer, weights: np.ndarray, intercepts: np.ndarray, comments: list, repeat: int) -> dict:
+    """
+    Scoring throughput pinned to one CPU core with BLAS/OpenMP limited to one thread: one call over
+    `repeat` copies of the comments, and one call per comment for the first 2000 comments.
+    """
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {min(os.sched_getaffinity(0))})
+    sample = list(comments) * repeat
+    with threadpool_limits(limits=1):
+        predict(vectorizer, weights, intercepts, sample[:100])
+        start = time.perf_counter()
+        predict(vectorizer, weights, intercepts, sample)
+        batched = time.perf_counter() - start
+        singles = sample[:2000]
+        start = time.perf_counter()
+        for comment in singles:
+            predict(vectorizer, weights, intercepts, [comment])
+        single = time.perf_counter() - start
+    return {
+        "comments": len(sample),
+        "batched_seconds": round(batched, 4),
+        "batched_comments_per_second": round(len(sample) / batched, 1),
+        "batched_microseconds_per_comment": round(batched / len(sample) * 1e6, 2),
+        "single_call_comments_per_second": round(len(singles) / single, 1),
+        "single_call_microseconds": round(single / len(singles) * 1e6, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Distil saved LLM confidences into a local multi-label model.")
+    parser.add_argument("--results", nargs="+", default=DEFAULT_RESULTS,
+                        help="glob patterns of saved result CSVs with <category>_confidence columns")
+    parser.add_argument("--dataset", default=DEFAULT_DATASET, help="gold labels, used for evaluation only")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="where to write the pickled artifact")
+    parser.add_argument("--report", default=DEFAULT_REPORT, help="where to write the JSON report")
+    parser.add_argument("--no-char-ngrams", action="store_true",
+                        help="word n-grams only: several times faster to score, somewhat less accurate")
+    parser.add_argument("--C", type=float, default=10.0, help="inverse regularisation strength")
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timing-repeat", type=int, default=20, help="copies of the comments scored for the benchmark")
+    args = parser.parse_args()
+
+    paths = sorted({path for pattern in args.results for path in glob.glob(pattern)})
+    comments, labels, runs, used = soft_labels(paths)
+    print(f"{len(comments)} comments from {len(used)} runs ({runs.mean():.1f} runs per comment)", file=sys.stderr)
+    char_ngrams = not args.no_char_ngrams
+
+    probabilities = np.zeros_like(labels)
+    for train, test in KFold(n_splits=args.folds, shuffle=True, random_state=args.seed).split(comments):
+        vectorizer = build_vectorizer(char_ngrams)
+        features = vectorizer.fit_transform([comments[i] for i in train])
+        weights, intercepts = fit_soft(features, labels[train], args.C)
+        probabilities[test] = predict(vectorizer, weights, intercepts, [comments[i] for i in test])
+
+    gold = pd.read_csv(args.dataset)
+    gold = dict(zip(gold["comment"].map(normalize_comment), gold["target"]))
+    has_gold = np.array([comment in gold for comment in comments])
+    y_gold = np.array([gold[comment] for comment in np.asarray(comments, dtype=object)[has_gold]])
+    disputed = (labels[:, 0] > DISPUTED_RANGE[0]) & (labels[:, 0] < DISPUTED_RANGE[1])
+
+    report = {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "teacher_runs": used,
+        "comments": len(comments),
+        "mean_runs_per_comment": round(float(runs.mean()), 2),
+        "disputed_comments": int(disputed.sum()),
+        "features": "word 1-2 grams + char 3-5 grams" if char_ngrams else "word 1-2 grams",
+        "folds": args.folds,
+        "soft_label_mae": round(float(np.abs(probabilities - labels).mean()), 4),
+        "agreement_with_teachers": agreement(probabilities, labels),
+        "gold_comments": int(has_gold.sum()),
+        "gold_binary_mcc": {
+            "teacher_consensus": round(float(matthews_corrcoef(y_gold, labels[has_gold, 0] < 0.5)), 4),
+            "distilled": round(float(matthews_corrcoef(y_gold, probabilities[has_gold, 0] < 0.5)), 4),
+        },
+        "thresholds": [],
+    }
+    for threshold in THRESHOLDS:
+        decided = np.array([decision is not None for decision in local_decisions(probabilities, threshold)])
+        report["thresholds"].append({
+            "threshold": threshold,
+            "decided_locally": round(float(decided.mean()), 4),
+            "agreement_with_teachers_when_decided": agreement(probabilities, labels, decided),
+            "disputed_forwarded_to_llm": round(float((disputed & ~decided).sum() / max(1, disputed.sum())), 4),
+        })
+        print(f"threshold {threshold}: {decided.mean():.1%} decided locally, "
+              f"binary agreement {report['thresholds'][-1]['agreement_with_teachers_when_decided']['binary']}",
+              file=sys.stderr)
+
+    vectorizer = build_vectorizer(char_ngrams)
+    weights, intercepts = fit_soft(vectorizer.fit_transform(comments), labels, args.C)
+    artifact = {
+        "vectorizer": vectorizer,
+        "weights": weights,
+        "intercepts": intercepts,
+        "categories": CATEGORIES,
+        "teacher_runs": used,
+        "trained_at": report["generated_at"],
+        "sklearn_version": sklearn.__version__,
+    }
+    with open(args.output, "wb") as f:
+        pickle.dump(artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+    report["artifact"] = os.path.relpath(os.path.abspath(args.output), REPO_ROOT)
+    report["artifact_bytes"] = os.path.getsize(args.output)
+    report["sklearn_version"] = sklearn.__version__
+
+    report["single_core_scoring"] = benchmark_single_core(vectorizer, weights, intercepts, comments, args.timing_repeat)
+    print(f"Single core: {report['single_core_scoring']['batched_comments_per_second']} comments/s batched, "
+          f"{report['single_core_scoring']['single_call_comments_per_second']} comments/s one at a time", file=sys.stderr)
+
+    with open(args.report, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output} and {args.report}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""
+Trains the local first-stage classifier used by the prompt scripts' --local-model option.
+
+A TF-IDF (word 1-2 grams + character 2-5 grams) / one-vs-rest logistic regression model is fitted
+on Datasets/final_dataset.csv, with one output per category in CATEGORIES ("None" for target == 0,
+the harmful categories from FinalLabels and the per-category columns). It scores a comment on CPU
+in microseconds, and the scripts only forward the comments it is unsure about to the LLM.
+
+The report compares, with 5-fold out-of-fold predictions, the LLM-only path (the saved GPT-4o
+prompt 17 results, the best complete run in results/fewshot/gpt) and the local model on its own
+against the hybrid path (local decisions where the model is confident, the same LLM results for the
+forwarded comments) over a range of confidence thresholds, and times local scoring:
+  python train_local_classifier.py
+  python train_local_classifier.py --output local_classifier.pkl --report local_classifier_report.json
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import pickle
+import argparse
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.pipeline import Pipeline, FeatureUnion
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.multiclass import OneVsRestClassifier
+from sklearn.model_selection import StratifiedKFold
+from sklearn.metrics import matthews_corrcoef, precision_recall_fscore_support
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+DEFAULT_DATASET = os.path.join(REPO_ROOT, "Datasets", "final_dataset.csv")
+DEFAULT_LLM_RESULTS = os.path.join(REPO_ROOT, "results", "fewshot", "gpt", "gpt4o_prompt17classification.csv")
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "local_classifier.pkl")
+DEFAULT_REPORT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "local_classifier_report.json")
+
+# Same order as CATEGORIES in the prompt scripts; the model's probability columns follow it
+CATEGORIES = [
+    "None", "Discredit", "Stereotyping", "Sexual_Harassment",
+    "Threats_of_Violence", "Maternal_Insults", "Sexual_Objectification",
+    "Anti-LGBTQ+", "Physical_Appearance", "Damning", "Dominance", "Dismissing"
+]
+
+# Per-category annotation columns of final_dataset.csv
+LABEL_COLUMNS = {
+    "Discredit": "Discredit",
+    "Stereotyping": "Stereotyping",
+    "Harassment": "Sexual_Harassment",
+    "Threats": "Threats_of_Violence",
+    "Maternal": "Maternal_Insults",
+    "Objectification": "Sexual_Objectification",
+    "AntiLGBTQ": "Anti-LGBTQ+",
+    "Appearance": "Physical_Appearance",
+    "Damning": "Damning",
+    "Dominance": "Dominance",
+    "Blaming": "Dismissing",
+}
+
+# Category names ignoring case, spaces, underscores and hyphens ("Maternal insults", "Neutral" in LLM output)
+CATEGORY_SEPARATORS_PATTERN = re.compile(r"[\s_\-\"]+")
+CATEGORY_ALIASES = {CATEGORY_SEPARATORS_PATTERN.sub("", cat).lower(): cat for cat in CATEGORIES}
+CATEGORY_ALIASES["neutral"] = "None"
+
+# Confidence thresholds evaluated in the report
+THRESHOLDS = [0.7, 0.8, 0.85, 0.9, 0.95, 0.98]
+
+
+def canonical_category(name: str):
+    return CATEGORY_ALIASES.get(CATEGORY_SEPARATORS_PATTERN.sub("", name).lower())
+
+
+def normalize_comment(comment) -> str:
+    """
+    Lower-cased comment with whitespace collapsed; the saved results differ from the dataset in spacing only.
+    """
+    return " ".join(str(comment).lower().split())
+
+
+def parse_labels(text) -> set:
+    """
+    Categories of a comma-separated label string such as FinalLabels or an LLM classification.
+    """
+    if not isinstance(text, str):
+        return set()
+    return {cat for cat in map(canonical_category, text.split(",")) if cat}
+
+
+def label_matrix(df: pd.DataFrame) -> np.ndarray:
+    """
+    Binary (rows x CATEGORIES) targets: "None" for target == 0, otherwise the union of the FinalLabels
+    categories and the per-category columns.
+    """
+    y = np.zeros((len(df), len(CATEGORIES)), dtype=np.int8)
+    for row, (target, final_labels) in enumerate(zip(df["target"], df["FinalLabels"])):
+        if target == 0:
+            y[row, 0] = 1
+            continue
+        for cat in parse_labels(final_labels) - {"None"}:
+            y[row, CATEGORIES.index(cat)] = 1
+    for column, cat in LABEL_COLUMNS.items():
+        y[:, CATEGORIES.index(cat)] |= (df[column].fillna(0).to_numpy() > 0) & (df["target"].to_numpy() == 1)
+    return y
+
+
+def build_pipeline() -> Pipeline:
+    features = FeatureUnion([
+        ("words", TfidfVectorizer(lowercase=True, ngram_range=(1, 2), min_df=2, sublinear_tf=True)),
+        ("chars", TfidfVectorizer(lowercase=True, analyzer="char_wb", ngram_range=(2, 5), min_df=2,
+                                  sublinear_tf=True, max_features=50000)),
+    ])
+    model = OneVsRestClassifier(LogisticRegression(C=10.0, class_weight="balanced", max_iter=2000))
+    return Pipeline([("tfidf", features), ("model", model)])
+
+
+def local_decisions(probabilities: np.ndarray, threshold: float) -> list:
+    """
+    Mirrors the scripts' confidence gate: a comment is decided locally as "None" when P(None) >= threshold,
+    or with its harmful categories when P(None) <= 1 - threshold and at least one category reaches
+    the threshold. Returns a set of categories per row, or None for comments forwarded to the LLM.
+    """
+    decisions = []
+    for p in probabilities:
+        if p[0] >= threshold:
+            decisions.append({"None"})
+        elif p[0] <= 1 - threshold and p[1:].max() >= threshold:
+            decisions.append({CATEGORIES[i] for i in range(1, len(CATEGORIES)) if p[i] >= threshold})
+        else:
+            decisions.append(None)
+    return decisions
+
+
+def local_only_predictions(probabilities: np.ndarray) -> list:
+    """
+    Local model without an LLM fallback: "None" when P(None) >= 0.5, otherwise every harmful category
+    with P >= 0.5 (or the most likely one).
+    """
+    predictions = []
+    for p in probabilities:
+        if p[0] >= 0.5:
+            predictions.append({"None"})
+            continue
+        labels = {CATEGORIES[i] for i in range(1, len(CATEGORIES)) if p[i] >= 0.5}
+        predictions.append(labels or {CATEGORIES[1 + int(np.argmax(p[1:]))]})
+    return predictions
+
+
+def score(true_sets: list, predicted_sets: list) -> dict:
+    """
+    Binary harmful/benign precision, recall, F1 and MCC, and micro/macro F1 over the harmful categories.
+    """
+    y_true = np.array([0 if labels == {"None"} else 1 for labels in true_sets])
+    y_pred = np.array([0 if not labels or labels == {"None"} else 1 for labels in predicted_sets])
+    precision, recall, f1, _ = precision_recall_fscore_support(y_true, y_pred, average="binary", zero_division=0)
+    harmful = CATEGORIES[1:]
+    true_matrix = np.array([[cat in labels for cat in harmful] for labels in true_sets])
+    pred_matrix = np.array([[cat in (labels or ()) for cat in harmful] for labels in predicted_sets])
+    _, _, micro_f1, _ = precision_recall_fscore_support(true_matrix, pred_matrix, average="micro", zero_division=0)
+    _, _, macro_f1, _ = precision_recall_fscore_support(true_matrix, pred_matrix, average="macro", zero_division=0)
+    return {
+        "binary_precision": round(float(precision), 4),
+        "binary_recall": round(float(recall), 4),
+        "binary_f1": round(float(f1), 4),
+        "binary_mcc": round(float(matthews_corrcoef(y_true, y_pred)), 4),
+        "category_micro_f1": round(float(micro_f1), 4),
+        "category_macro_f1": round(float(macro_f1), 4),
+    }
+
+
+def out_of_fold_probabilities(comments: list, y: np.ndarray, folds: int, seed: int) -> np.ndarray:
+    """
+    Predicted probabilities for every comment from a model that did not see it, stratified on harmful/benign.
+    """
+    probabilities = np.zeros(y.shape, dtype=np.float64)
+    splitter = StratifiedKFold(n_splits=folds, shuffle=True, random_state=seed)
+    comments = np.asarray(comments, dtype=object)
+    for train, test in splitter.split(comments, 1 - y[:, 0]):
+        pipeline = build_pipeline().fit(comments[train], y[train])
+        probabilities[test] = pipeline.predict_proba(comments[test])
+    return probabilities
+
+
+def time_scoring(pipeline: Pipeline, comments: list, repeat: int) -> dict:
+    """
+    Single-threaded scoring time of the fitted pipeline over `repeat` copies of the comments.
+    """
+    sample = list(comments) * repeat
+    pipeline.predict_proba(sample[:100])
+    start = time.perf_counter()
+    pipeline.predict_proba(sample)
+    elapsed = time.perf_counter() - start
+    return {
+        "comments": len(sample),
+        "seconds": round(elapsed, 4),
+        "microseconds_per_comment": round(elapsed / len(sample) * 1e6, 2),
+        "comments_per_second": round(len(sample) / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the local TF-IDF + logistic regression first-stage classifier.")
+    parser.add_argument("--dataset", default=DEFAULT_DATASET, help="labelled CSV (comment, target, FinalLabels, category columns)")
+    parser.add_argument("--llm-results", default=DEFAULT_LLM_RESULTS,
+                        help="saved LLM-only classifications of the same comments, for the comparison")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="where to write the pickled model artifact")
+    parser.add_argument("--report", default=DEFAULT_REPORT, help="where to write the JSON evaluation report")
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timing-repeat", type=int, default=20, help="copies of the dataset scored for the timing")
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.dataset)
+    df = df[df["comment"].notna()].reset_index(drop=True)
+    comments = df["comment"].astype(str).tolist()
+    y = label_matrix(df)
+    true_sets = [{CATEGORIES[i] for i in np.flatnonzero(row)} for row in y]
+    print(f"Training on {len(df)} comments ({int(y[:, 0].sum())} benign)", file=sys.stderr)
+
+    probabilities = out_of_fold_probabilities(comments, y, args.folds, args.seed)
+
+    # LLM-only baseline over the comments it has results for (matched by normalised text; not every row has a CommentID)
+    llm = pd.read_csv(args.llm_results)
+    llm = dict(zip(llm["comment"].map(normalize_comment), llm["classification"]))
+    keys = [normalize_comment(comment) for comment in comments]
+    has_llm = np.array([key in llm for key in keys])
+    llm_sets = [parse_labels(llm[key]) or {"None"} if key in llm else None for key in keys]
+    evaluated = np.flatnonzero(has_llm)
+    local_only = local_only_predictions(probabilities)
+    report = {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "dataset": os.path.relpath(os.path.abspath(args.dataset), REPO_ROOT),
+        "llm_results": os.path.relpath(os.path.abspath(args.llm_results), REPO_ROOT),
+        "comments": len(df),
+        "compared_comments": int(len(evaluated)),
+        "folds": args.folds,
+        "llm_only": score([true_sets[i] for i in evaluated], [llm_sets[i] for i in evaluated]),
+        "local_only": score([true_sets[i] for i in evaluated], [local_only[i] for i in evaluated]),
+        "thresholds": [],
+    }
+    for threshold in THRESHOLDS:
+        decisions = local_decisions(probabilities, threshold)
+        hybrid = [decisions[i] if decisions[i] is not None else llm_sets[i] for i in evaluated]
+        decided = [i for i in evaluated if decisions[i] is not None]
+        report["thresholds"].append({
+            "threshold": threshold,
+            "decided_locally": len(decided),
+            "forwarded_to_llm": int(len(evaluated) - len(decided)),
+            "llm_calls_saved": round(len(decided) / len(evaluated), 4),
+            "local_decision_accuracy": round(float(np.mean([decisions[i] == true_sets[i] for i in decided])), 4) if decided else None,
+            "hybrid": score([true_sets[i] for i in evaluated], hybrid),
+        })
+        print(f"threshold {threshold}: {len(decided)}/{len(evaluated)} decided locally, "
+              f"hybrid binary MCC {report['thresholds'][-1]['hybrid']['binary_mcc']} "
+              f"(LLM only {report['llm_only']['binary_mcc']})", file=sys.stderr)
+
+    pipeline = build_pipeline().fit(comments, y)
+    report["local_scoring"] = time_scoring(pipeline, comments, args.timing_repeat)
+    artifact = {
+        "pipeline": pipeline,
+        "categories": CATEGORIES,
+        "trained_on": report["dataset"],
+        "trained_at": report["generated_at"],
+        "sklearn_version": sklearn.__version__,
+    }
+    with open(args.output, "wb") as f:
+        pickle.dump(artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+    report["artifact"] = os.path.relpath(os.path.abspath(args.output), REPO_ROOT)
+    report["artifact_bytes"] = os.path.getsize(args.output)
+    report["sklearn_version"] = sklearn.__version__
+
+    with open(args.report, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output} and {args.report}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Benchmark of the output assembly step (build_output_frame) at scale.
+
+Generates synthetic classification results for N rows (1,000,000 by default) and times:
+  - per_cell: the previous implementation, kept here as a reference, which writes every
+    <category>_confidence cell with df.at (12 scalar DataFrame writes per comment)
+  - vectorised: build_output_frame of the shared pipeline module, which fills one float32 matrix and attaches
+    all output columns in a single operation
+Both outputs are checked for equality before the timings are reported as JSON, e.g.
+  python benchmark_output_assembly.py --script gpt --rows 1000000
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import importlib.util
+
+import numpy as np
+import pandas as pd
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+SCRIPTS = {
+    "gpt": os.path.join(REPO_ROOT, "Prompts", "few-shot", "gpt", "GPTprompt20.py"),
+    "together": os.path.join(REPO_ROOT, "Prompts", "few-shot", "together-ai", "togetheraiprompt20.py"),
+}
+
+
+def load_script(path: str):
+    """
+    Imports a prompt script as a module without running its main().
+    """
+    spec = importlib.util.spec_from_file_location("classification_script", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_output_frame_per_cell(df: pd.DataFrame, results: dict, categories: list) -> pd.DataFrame:
+    """
+    Reference copy of the per-cell assembly that build_output_frame replaced.
+    """
+    df = df.reset_index(drop=True)
+    for cat in categories:
+        df[f"{cat}_confidence"] = 0.0
+
+    classifications_list = []
+    reasonings_list = []
+
+    for idx in range(1, len(df) + 1):
+        result = results.get(idx, {"classification": [{"category": "None", "confidence": 0.50}],
+                                   "reasoning": "No output"})
+        current_categories = []
+        current_confidences = {cat: 0.0 for cat in categories}
+        for entry in result["classification"]:
+            cat = entry["category"]
+            conf = entry["confidence"]
+            current_confidences[cat] = conf
+            current_categories.append(cat)
+        if not current_categories:
+            current_categories = ["None"]
+        for cat in categories:
+            df.at[idx-1, f"{cat}_confidence"] = current_confidences.get(cat, 0.0)
+        classifications_list.append(", ".join(current_categories))
+        reasonings_list.append(result["reasoning"])
+
+    df["classification"] = classifications_list
+    df["reasoning"] = reasonings_list
+    return df
+
+
+def synthetic_results(rows: int, categories: list, seed: int) -> tuple:
+    """
+    Builds an input frame and {1-based index: result} with one to three labels per comment,
+    leaving about 1% of the rows without a result so the default path is exercised too.
+    """
+    rng = random.Random(seed)
+    df = pd.DataFrame({"CommentID": np.arange(rows), "comment": [f"comment {i}" for i in range(rows)]})
+    results = {}
+    for idx in range(1, rows + 1):
+        if rng.random() < 0.01:
+            continue
+        if rng.random() < 0.7:
+            labels = [{"category": "None", "confidence": round(rng.uniform(0.8, 1.0), 2)}]
+        else:
+            labels = [{"category": cat, "confidence": round(rng.uniform(0.5, 1.0), 2)}
+                      for cat in rng.sample(categories[1:], rng.randint(1, 3))]
+        results[idx] = {"classification": labels, "reasoning": "Synthetic reasoning."}
+    return df, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-cell versus vectorised output assembly.")
+    parser.add_argument("--script", choices=sorted(SCRIPTS), default="gpt")
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip-per-cell", action="store_true", help="only time the vectorised assembly")
+    args = parser.parse_args()
+
+    module = load_script(SCRIPTS[args.script]).pipeline
+    df, results = synthetic_results(args.rows, module.CATEGORIES, args.seed)
+    report = {"script": args.script, "rows": args.rows}
+
+    start = time.perf_counter()
+    vectorised = module.build_output_frame(df, results)
+    report["vectorised_seconds"] = round(time.perf_counter() - start, 3)
+    print(f"vectorised: {report['vectorised_seconds']} s", file=sys.stderr)
+
+    if not args.skip_per_cell:
+        start = time.perf_counter()
+        per_cell = build_output_frame_per_cell(df, results, module.CATEGORIES)
+        report["per_cell_seconds"] = round(time.perf_counter() - start, 3)
+        report["speedup"] = round(report["per_cell_seconds"] / report["vectorised_seconds"], 1)
+        print(f"per_cell: {report['per_cell_seconds']} s", file=sys.stderr)
+        # Confidences are stored as float32 now, so compare at float32 precision
+        pd.testing.assert_frame_equal(vectorised, per_cell, check_dtype=False, atol=1e-6)
+        report["outputs_equal"] = True
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+"""
+End-to-end throughput benchmark for the batched classification pipeline.
+
+Loads one of the prompt scripts (GPTprompt20.py or togetheraiprompt20.py) and runs the real
+classify_in_batches -> parse_batch_classification -> build_output_frame path of the shared
+classification_pipeline module, with the script's network call (request_completion /
+request_completion_async) replaced by the in-process MockLLM from
+mock_llm_server.py. Batch size and concurrency are swept over Datasets/final_dataset.csv and
+synthetic scale-ups of it, and every configuration reports:
+  - comments/sec over the whole run (classification + DataFrame assembly)
+  - p50/p95/p99 latency of the top-level batches (including parsing and salvage requests)
+  - peak RSS of the process that ran it
+
+With --gate, the script's two-stage mode (classify_in_stages: harmful/benign gate prompt first,
+fine-grained prompt for the rest) is benchmarked instead of a single classify_in_batches pass.
+With --ensemble, the same goes for the ensemble mode (two models per comment, a third on disagreement);
+--disagree-rate sets how often each mock model departs from the shared verdict.
+
+Each configuration runs in a fresh process so peak RSS is not inherited from earlier runs.
+The response cache and the rate limiter are disabled, so every run does the same work.
+Results are written as JSON, e.g.
+  python benchmark_pipeline.py --script gpt --batch-sizes 5,10,20 --concurrency 1,8,32 --scales 1,10 --output bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import functools
+import platform
+import resource
+import contextvars
+import importlib.util
+import multiprocessing
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from mock_llm_server import MockLLM
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+SCRIPTS = {
+    "gpt": os.path.join(REPO_ROOT, "Prompts", "few-shot", "gpt", "GPTprompt20.py"),
+    "together": os.path.join(REPO_ROOT, "Prompts", "few-shot", "together-ai", "togetheraiprompt20.py"),
+}
+
+DEFAULT_DATASET = os.path.join(REPO_ROOT, "Datasets", "final_dataset.csv")
+
+PERCENTILES = (50, 95, 99)
+
+# Nesting depth of classify_batch calls, so salvage sub-batches are not counted as batches of their own
+_batch_depth = contextvars.ContextVar("batch_depth", default=0)
+
+
+def load_script(path: str):
+    """
+    Imports a prompt script as a module without running its main().
+    The shared classification_pipeline module is re-imported with it, so every load starts from its defaults.
+    """
+    sys.modules.pop("classification_pipeline", None)
+    spec = importlib.util.spec_from_file_location("classification_script", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_comments(dataset: str, scale: int) -> pd.DataFrame:
+    """
+    Reads the dataset and repeats it `scale` times. Each copy gets a numbered suffix so that
+    comment de-duplication does not collapse the scale-up back to the original size.
+    """
+    df = pd.read_csv(dataset)
+    if scale <= 1:
+        return df
+    copies = [df]
+    for k in range(1, scale):
+        copy = df.copy()
+        copy["comment"] = copy["comment"].astype(str) + f" (copy {k})"
+        copies.append(copy)
+    return pd.concat(copies, ignore_index=True)
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident set size of this process in MiB (ru_maxrss is KiB on Linux and bytes on macOS).
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def latency_summary(samples: list) -> dict:
+    """
+    Percentiles of a list of latencies in seconds, reported in milliseconds.
+    """
+    if not samples:
+        return {f"p{p}": None for p in PERCENTILES}
+    values = np.percentile(np.asarray(samples) * 1000, PERCENTILES)
+    return {f"p{p}": round(float(v), 3) for p, v in zip(PERCENTILES, values)}
+
+
+def install_fake_backend(pipeline, llm: MockLLM, request_latencies: list, batch_latencies: list):
+    """
+    Replaces the request functions the script installed in `pipeline` with calls into `llm`, and wraps classify_batch so the
+    latency of every top-level batch is recorded. Everything else runs unmodified.
+    """
+    def render(payload, max_tokens: int):
+        # GPT scripts send chat messages (static system prompt first), Together scripts one prompt string
+        if isinstance(payload, list):
+            prefix = payload[0]["content"] if payload else ""
+            prompt_text = "\n".join(m["content"] for m in payload)
+        else:
+            first = pipeline.re.search(r'^Comment #\d+:', payload, pipeline.re.MULTILINE)
+            prefix = payload[:first.start()] if first else payload
+            prompt_text = payload
+        text, finish_reason, completion_tokens = llm.render(
+            prompt_text, max_tokens, pipeline.OUTPUT_FORMAT == "json" and not pipeline.GATE_ACTIVE,
+            pipeline.INCLUDE_REASONING, pipeline.GATE_ACTIVE, pipeline.active_model())
+        usage = llm.usage(prefix, prompt_text, completion_tokens)
+        pipeline.USAGE_STATS.record(usage["prompt_tokens"], usage["completion_tokens"], usage["cached_tokens"])
+        return text, finish_reason == "length", llm.sample_latency(completion_tokens)
+
+    def request_completion(payload, max_tokens: int = pipeline.MAX_COMPLETION_TOKENS, on_block=None) -> tuple:
+        start = time.perf_counter()
+        text, truncated, delay = render(payload, max_tokens)
+        time.sleep(delay)
+        request_latencies.append(time.perf_counter() - start)
+        return text, truncated
+
+    async def request_completion_async(payload, client, max_tokens: int = pipeline.MAX_COMPLETION_TOKENS,
+                                       on_block=None) -> tuple:
+        start = time.perf_counter()
+        text, truncated, delay = render(payload, max_tokens)
+        await asyncio.sleep(delay)
+        request_latencies.append(time.perf_counter() - start)
+        return text, truncated
+
+    classify_batch = pipeline.classify_batch
+    classify_batch_async = pipeline.classify_batch_async
+
+    def timed_classify_batch(comments: list, *args, **kwargs) -> dict:
+        depth = _batch_depth.get()
+        token = _batch_depth.set(depth + 1)
+        start = time.perf_counter()
+        try:
+            return classify_batch(comments, *args, **kwargs)
+        finally:
+            if depth == 0:
+                batch_latencies.append(time.perf_counter() - start)
+            _batch_depth.reset(token)
+
+    async def timed_classify_batch_async(comments: list, *args, **kwargs) -> dict:
+        depth = _batch_depth.get()
+        token = _batch_depth.set(depth + 1)
+        start = time.perf_counter()
+        try:
+            return await classify_batch_async(comments, *args, **kwargs)
+        finally:
+            if depth == 0:
+                batch_latencies.append(time.perf_counter() - start)
+            _batch_depth.reset(token)
+
+    pipeline.request_completion = request_completion
+    pipeline.request_completion_async = request_completion_async
+    pipeline.classify_batch = timed_classify_batch
+    pipeline.classify_batch_async = timed_classify_batch_async
+
+
+def run_config(config: dict) -> dict:
+    """
+    Runs one benchmark configuration end to end and returns its measurements.
+    """
+    pipeline = load_script(config["script_path"]).pipeline
+    pipeline.CACHE_PATH = None
+    pipeline.RATE_LIMITS = {}
+    pipeline.USAGE_STATS = pipeline.UsageStats()
+    pipeline.OUTPUT_FORMAT = config["output_format"]
+    pipeline.INCLUDE_REASONING = not config["no_reasoning"]
+    llm = MockLLM(**config["mock"])
+    request_latencies, batch_latencies = [], []
+    install_fake_backend(pipeline, llm, request_latencies, batch_latencies)
+
+    df = load_comments(config["dataset"], config["scale"])
+    comments = df["comment"].tolist()
+    rss_before = peak_rss_mb()
+
+    staged = config["gate"] or config["ensemble"]
+    if staged:
+        pipeline.USE_GATE = config["gate"]
+        pipeline.USE_ENSEMBLE = config["ensemble"]
+        pipeline.USE_ASYNC = config["mode"] == "async"
+        pipeline.MAX_BATCH_ITEMS = config["batch_size"]
+        # classify_in_stages reaches both pipelines through classify_comments; pin their concurrency here
+        pipeline.classify_in_batches = functools.partial(pipeline.classify_in_batches, max_workers=config["concurrency"])
+        pipeline.classify_in_batches_async = functools.partial(
+            pipeline.classify_in_batches_async, max_concurrency=config["concurrency"])
+
+    start = time.perf_counter()
+    if staged:
+        results = pipeline.classify_in_stages(comments)
+    elif config["mode"] == "async":
+        results = asyncio.run(pipeline.classify_in_batches_async(
+            comments, batch_size=config["batch_size"], max_concurrency=config["concurrency"]))
+    else:
+        results = pipeline.classify_in_batches(
+            comments, batch_size=config["batch_size"], max_workers=config["concurrency"])
+    classified = time.perf_counter()
+    pipeline.build_output_frame(df, results)
+    elapsed = time.perf_counter() - start
+
+    usage = pipeline.USAGE_STATS
+    return {
+        "script": config["script"],
+        "mode": config["mode"],
+        "output_format": config["output_format"],
+        "no_reasoning": config["no_reasoning"],
+        "gate": config["gate"],
+        "ensemble": config["ensemble"],
+        "scale": config["scale"],
+        "batch_size": config["batch_size"],
+        "concurrency": config["concurrency"],
+        "comments": len(comments),
+        "batches": len(batch_latencies),
+        "requests": len(request_latencies),
+        "fallbacks": sum(1 for res in results.values() if res.get("fallback")),
+        "gate_cleared": sum(1 for res in results.values() if res["reasoning"] == pipeline.GATE_CLEARED_REASONING),
+        "wall_seconds": round(elapsed, 4),
+        "classify_seconds": round(classified - start, 4),
+        "assembly_seconds": round(elapsed - (classified - start), 4),
+        "comments_per_second": round(len(comments) / elapsed, 2) if elapsed else None,
+        "batch_latency_ms": latency_summary(batch_latencies),
+        "request_latency_ms": latency_summary(request_latencies),
+        "prompt_tokens": usage.prompt_tokens,
+        "cached_tokens": usage.cached_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "peak_rss_mb_before_run": round(rss_before, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def run_isolated(config: dict) -> dict:
+    """
+    Runs a configuration in a freshly spawned process so its peak RSS is its own.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(run_config, config).result()
+
+
+def parse_int_list(text: str) -> list:
+    return [int(value) for value in text.split(",") if value.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the classification pipeline against an in-process mock LLM.")
+    parser.add_argument("--script", choices=sorted(SCRIPTS), default="gpt", help="prompt script to benchmark")
+    parser.add_argument("--script-path", help="benchmark this script file instead of one of the built-in ones")
+    parser.add_argument("--dataset", default=DEFAULT_DATASET, help="CSV file with a 'comment' column")
+    parser.add_argument("--scales", type=parse_int_list, default=[1, 10],
+                        help="comma-separated multiples of the dataset to run (synthetic scale-up)")
+    parser.add_argument("--batch-sizes", type=parse_int_list, default=[5, 10, 20],
+                        help="comma-separated maximum comments per request")
+    parser.add_argument("--concurrency", type=parse_int_list, default=[1, 8, 32],
+                        help="comma-separated numbers of requests in flight")
+    parser.add_argument("--mode", choices=["threads", "async"], default="threads",
+                        help="classify_in_batches (thread pool) or classify_in_batches_async")
+    parser.add_argument("--output-format", choices=["text", "json"], default="text",
+                        help="OUTPUT_FORMAT of the script: Comment #<n> text blocks or JSON output")
+    parser.add_argument("--no-reasoning", action="store_true", help="run the script's reasoning-free mode")
+    parser.add_argument("--gate", action="store_true", help="run the script's two-stage gate mode")
+    parser.add_argument("--ensemble", action="store_true", help="run the script's ensemble mode")
+    parser.add_argument("--latency", choices=["fixed", "uniform", "lognormal"], default="fixed")
+    parser.add_argument("--latency-mean", type=float, default=0.05, help="mean time to first token in seconds")
+    parser.add_argument("--latency-sd", type=float, default=0.02)
+    parser.add_argument("--token-latency", type=float, default=0.0, help="extra seconds per generated token")
+    parser.add_argument("--truncate-rate", type=float, default=0.0)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--disagree-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--in-process", action="store_true",
+                        help="run every configuration in this process (faster, but peak RSS accumulates)")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    script_path = os.path.abspath(args.script_path or SCRIPTS[args.script])
+    mock = {
+        "latency": args.latency, "latency_mean": args.latency_mean, "latency_sd": args.latency_sd,
+        "token_latency": args.token_latency, "truncate_rate": args.truncate_rate,
+        "malformed_rate": args.malformed_rate, "disagree_rate": args.disagree_rate, "seed": args.seed,
+    }
+    runner = run_config if args.in_process else run_isolated
+
+    runs = []
+    for scale in args.scales:
+        for batch_size in args.batch_sizes:
+            for concurrency in args.concurrency:
+                config = {
+                    "script": args.script_path or args.script, "script_path": script_path,
+                    "dataset": os.path.abspath(args.dataset), "scale": scale, "mode": args.mode,
+                    "output_format": args.output_format, "no_reasoning": args.no_reasoning,
+                    "gate": args.gate, "ensemble": args.ensemble, "batch_size": batch_size, "concurrency": concurrency, "mock": mock,
+                }
+                run = runner(config)
+                print(f"scale={scale} batch_size={batch_size} concurrency={concurrency}: "
+                      f"{run['comments_per_second']} comments/s, p95 batch {run['batch_latency_ms']['p95']} ms, "
+                      f"peak RSS {run['peak_rss_mb']} MiB", file=sys.stderr)
+                runs.append(run)
+
+    report = {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "dataset": os.path.relpath(os.path.abspath(args.dataset), REPO_ROOT),
+        "mock": mock,
+        "runs": runs,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+"""
+Local stand-in for the LLM backends used by the prompt scripts, for benchmarking and load-testing
+without spending API quota.
+
+It speaks the request/response shapes of:
+  - azure.ai.inference.ChatCompletionsClient.complete  (POST .../chat/completions)
+  - the Together completions API used by together.Complete.create and the aiohttp path
+    (POST /v1/completions, /inference or /api/inference)
+
+Responses follow the batched format expected by parse_batch_classification:
+  Comment #<number>:
+  Classification: Category1 (confidence), ...
+  Reasoning: <explanation>
+or, when the request sets response_format or the prompt asks for JSON (OUTPUT_FORMAT = "json"),
+  {"results": [{"id": <number>, "labels": [<category index>], "conf": [<confidence>], "reasoning": "..."}]}
+Reasoning is left out when the prompt asks for none. The gate prompt of a two-stage run (--gate) is
+answered with one "Comment #<number>: Harmful (confidence)" or "Benign (confidence)" line per comment.
+
+With --disagree-rate, each model named in the request departs from the shared verdict on that share of the
+comments (deterministically per model and comment), so cascades and ensembles see models that disagree.
+
+Requests with "stream": true (or "stream_tokens": true) are answered as server-sent events, one
+"data: {...}" chunk per token followed by "data: [DONE]".
+
+Latency, throttling (429 with Retry-After), server errors, truncation and malformed output are all
+configurable, e.g.
+  python mock_llm_server.py --port 8000 --latency lognormal --latency-mean 1.5 --rate-429 0.05
+and point the scripts at it with MODEL_ENDPOINT=http://127.0.0.1:8000 (Azure) or
+TOGETHER_COMPLETIONS_URL=http://127.0.0.1:8000/v1/completions (Together, USE_ASYNC = True).
+"""
+
+import re
+import math
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+CATEGORIES = [
+    "None", "Discredit", "Stereotyping", "Sexual_Harassment",
+    "Threats_of_Violence", "Maternal_Insults", "Sexual_Objectification",
+    "Anti-LGBTQ+", "Physical_Appearance", "Damning", "Dominance", "Dismissing"
+]
+
+COMMENT_PATTERN = re.compile(r'^Comment #(\d+): "(.*)"\s*$', re.MULTILINE)
+
+# Present in the JSON-mode prompt's format section
+JSON_FORMAT_MARKER = '{"results": ['
+# Present in the reasoning-free prompt (--no-reasoning)
+NO_REASONING_MARKER = "Do not write any reasoning"
+# Present in the harmful/benign gate prompt (--gate)
+GATE_MARKER = "Comment #<number>: Benign (confidence)"
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+class MockLLM:
+    """
+    Generates batched classification responses and decides which faults to inject.
+    Used by the HTTP server below and directly, in-process, by the benchmark scripts.
+    """
+
+    def __init__(self, latency="fixed", latency_mean=0.5, latency_sd=0.25, token_latency=0.0,
+                 rate_429=0.0, retry_after=1.0, rate_5xx=0.0, truncate_rate=0.0, malformed_rate=0.0,
+                 harmful_rate=0.3, disagree_rate=0.0, seed=None):
+        self.latency = latency
+        self.latency_mean = latency_mean
+        self.latency_sd = latency_sd
+        self.token_latency = token_latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.rate_5xx = rate_5xx
+        self.truncate_rate = truncate_rate
+        self.malformed_rate = malformed_rate
+        self.harmful_rate = harmful_rate
+        self.disagree_rate = disagree_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.seen_prefixes = set()
+
+    def _uniform(self) -> float:
+        with self.lock:
+            return self.random.random()
+
+    def sample_latency(self, completion_tokens: int = 0) -> float:
+        """
+        Seconds to wait before answering: time to first token from the configured distribution,
+        plus token_latency seconds per generated token.
+        """
+        with self.lock:
+            if self.latency == "uniform":
+                base = self.random.uniform(max(0.0, self.latency_mean - self.latency_sd), self.latency_mean + self.latency_sd)
+            elif self.latency == "lognormal":
+                # Parameterised by the mean and standard deviation of the latency itself
+                variance = self.latency_sd ** 2
+                sigma2 = 0.0 if self.latency_mean <= 0 else math.log(1 + variance / self.latency_mean ** 2)
+                mu = math.log(max(self.latency_mean, 1e-9)) - sigma2 / 2
+                base = self.random.lognormvariate(mu, sigma2 ** 0.5)
+            else:
+                base = self.latency_mean
+        return base + completion_tokens * self.token_latency
+
+    def pick_error(self):
+        """
+        Returns (status, headers) for an injected error, or None to answer normally.
+        """
+        roll = self._uniform()
+        if roll < self.rate_429:
+            return 429, {"Retry-After": f"{self.retry_after:g}"}
+        if roll < self.rate_429 + self.rate_5xx:
+            return 503, {}
+        return None
+
+    def classify(self, comment: str, model: str = ""):
+        """
+        Deterministic pseudo-classification of one comment, so repeated runs see the same labels.
+        With disagree_rate, `model` answers some comments as if they were a different one.
+        """
+        digest = int(hashlib.sha256(comment.encode("utf-8")).hexdigest(), 16)
+        if model and self.disagree_rate:
+            model_digest = int(hashlib.sha256(f"{model}\n{comment}".encode("utf-8")).hexdigest(), 16)
+            if (model_digest % 1000) / 1000 < self.disagree_rate:
+                digest = model_digest >> 10
+        if (digest % 1000) / 1000 >= self.harmful_rate:
+            return [("None", 0.97)], "A neutral technical comment with no sexist or identity-based content."
+        category = CATEGORIES[1 + (digest >> 10) % (len(CATEGORIES) - 1)]
+        confidence = 0.85 + ((digest >> 20) % 14) / 100
+        return [(category, confidence)], f"Mock verdict: the comment reads as {category.replace('_', ' ').lower()}."
+
+    def render(self, prompt_text: str, max_tokens: int, json_mode: bool = False, include_reasoning: bool = True,
+               gate: bool = False, model: str = "") -> tuple:
+        """
+        Builds the response text for every `Comment #<n>: "..."` line in the prompt, as text blocks or,
+        with `json_mode`, as one JSON object, with or without reasoning. With `gate`, each comment gets a
+        one-line harmful/benign verdict consistent with classify(), which answers as `model`.
+        Returns (text, finish_reason, completion_tokens), applying truncation and malformed-output injection.
+        """
+        blocks = []
+        for number, comment in COMMENT_PATTERN.findall(prompt_text):
+            labels, reasoning = self.classify(comment, model)
+            if gate:
+                category, confidence = labels[0]
+                verdict = "Benign" if category == "None" else "Harmful"
+                blocks.append(f"Comment #{number}: {verdict} ({confidence:.2f})")
+                continue
+            if json_mode:
+                item = {
+                    "id": int(number),
+                    "labels": [CATEGORIES.index(category) for category, _ in labels],
+                    "conf": [confidence for _, confidence in labels]
+                }
+                if include_reasoning:
+                    item["reasoning"] = reasoning
+                blocks.append(json.dumps(item))
+                continue
+            classification = ", ".join(f"{category} ({confidence:.2f})" for category, confidence in labels)
+            block = f"Comment #{number}:\nClassification: {classification}"
+            blocks.append(f"{block}\nReasoning: {reasoning}" if include_reasoning else block)
+
+        if blocks and self._uniform() < self.malformed_rate:
+            victim = int(self._uniform() * len(blocks))
+            if self._uniform() < 0.5:
+                # Drop the block entirely
+                del blocks[victim]
+            elif gate:
+                # Verdict missing
+                blocks[victim] = blocks[victim].split(":")[0] + ":"
+            elif json_mode:
+                # Labels without confidences
+                blocks[victim] = re.sub(r'"conf": \[[^\]]*\]', '"conf": []', blocks[victim])
+            else:
+                # Break the classification line (category with a space, no confidence)
+                blocks[victim] = re.sub(r"Classification: .*", "Classification: Sexual Harassment", blocks[victim])
+
+        if gate:
+            text = "\n".join(blocks)
+        elif json_mode:
+            text = '{"results": [' + ", ".join(blocks) + "]}"
+        else:
+            text = "\n\n".join(blocks)
+        finish_reason = "stop"
+        if estimate_tokens(text) > max_tokens:
+            text = text[:max_tokens * 4]
+            finish_reason = "length"
+        elif blocks and self._uniform() < self.truncate_rate:
+            text = text[:int(len(text) * (0.3 + 0.6 * self._uniform()))]
+            finish_reason = "length"
+        return text, finish_reason, estimate_tokens(text)
+
+    def usage(self, prefix: str, prompt_text: str, completion_tokens: int) -> dict:
+        """
+        Usage block; a prefix seen before is reported as cached, emulating provider prompt caching.
+        """
+        prefix_hash = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+        with self.lock:
+            cached = prefix_hash in self.seen_prefixes
+            self.seen_prefixes.add(prefix_hash)
+        prompt_tokens = estimate_tokens(prompt_text)
+        cached_tokens = estimate_tokens(prefix) if cached else 0
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "cached_tokens": cached_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens}
+        }
+
+
+def chat_completion_body(model: str, text: str, finish_reason: str, usage: dict) -> dict:
+    return {
+        "id": f"mock-{time.time_ns()}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "finish_reason": finish_reason, "message": {"role": "assistant", "content": text}}],
+        "usage": usage
+    }
+
+
+def text_completion_body(model: str, text: str, finish_reason: str, usage: dict) -> dict:
+    choices = [{"index": 0, "text": text, "finish_reason": finish_reason}]
+    return {
+        "id": f"mock-{time.time_ns()}",
+        "object": "text_completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": choices,
+        # Older together clients read the choices from an "output" envelope
+        "output": {"choices": choices},
+        "usage": usage
+    }
+
+
+def chat_completion_chunks(model: str, text: str, finish_reason: str, usage: dict) -> list:
+    """
+    Streamed form of chat_completion_body: one delta per token, then the finish reason and usage.
+    """
+    created = int(time.time())
+    chunk_id = f"mock-{time.time_ns()}"
+    def chunk(delta: dict, finish=None, usage_block=None):
+        return {
+            "id": chunk_id, "object": "chat.completion.chunk", "created": created, "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish}], "usage": usage_block
+        }
+    chunks = [chunk({"role": "assistant", "content": piece}) for piece in split_tokens(text)]
+    chunks.append(chunk({}, finish_reason, usage))
+    return chunks
+
+
+def text_completion_chunks(model: str, text: str, finish_reason: str, usage: dict) -> list:
+    """
+    Streamed form of text_completion_body: one text piece per token, then the finish reason and usage.
+    """
+    created = int(time.time())
+    chunk_id = f"mock-{time.time_ns()}"
+    def chunk(piece: str, finish=None, usage_block=None):
+        return {
+            "id": chunk_id, "object": "completion.chunk", "created": created, "model": model,
+            "choices": [{"index": 0, "text": piece, "finish_reason": finish}], "usage": usage_block
+        }
+    chunks = [chunk(piece) for piece in split_tokens(text)]
+    chunks.append(chunk("", finish_reason, usage))
+    return chunks
+
+
+def split_tokens(text: str) -> list:
+    """
+    Rough tokenisation for streaming: words with their trailing whitespace.
+    """
+    return re.findall(r"\S+\s*|\s+", text)
+
+
+def make_handler(llm: MockLLM):
+    class MockHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send_json(self, status: int, body: dict, headers: dict = None):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _send_stream(self, chunks: list, first_token_delay: float):
+            # No Content-Length: the body is delimited by closing the connection
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            time.sleep(first_token_delay)
+            for k, chunk in enumerate(chunks):
+                if k and llm.token_latency:
+                    time.sleep(llm.token_latency)
+                self.wfile.write(b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n")
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                request = json.loads(self.rfile.read(length) or b"{}")
+            except json.JSONDecodeError:
+                self._send_json(400, {"error": {"message": "Invalid JSON body"}})
+                return
+            path = self.path.split("?", 1)[0]
+
+            if path.endswith("/chat/completions"):
+                messages = request.get("messages", [])
+                prefix = messages[0]["content"] if messages else ""
+                prompt_text = "\n".join(m.get("content", "") for m in messages)
+                build_body = chat_completion_body
+                build_chunks = chat_completion_chunks
+            elif path.endswith("/completions") or path.endswith("/inference"):
+                prompt_text = request.get("prompt", "")
+                # Everything before the first numbered comment is the static prefix
+                first = COMMENT_PATTERN.search(prompt_text)
+                prefix = prompt_text[:first.start()] if first else prompt_text
+                build_body = text_completion_body
+                build_chunks = text_completion_chunks
+            else:
+                self._send_json(404, {"error": {"message": f"Unknown path {path}"}})
+                return
+
+            error = llm.pick_error()
+            if error:
+                status, headers = error
+                time.sleep(llm.sample_latency() / 10)
+                self._send_json(status, {"error": {"message": f"Injected {status} error"}}, headers)
+                return
+
+            json_mode = bool(request.get("response_format")) or JSON_FORMAT_MARKER in prompt_text
+            include_reasoning = NO_REASONING_MARKER not in prompt_text
+            gate = GATE_MARKER in prompt_text
+            model = request.get("model", "mock-model")
+            text, finish_reason, completion_tokens = llm.render(
+                prompt_text, int(request.get("max_tokens") or 1000), json_mode and not gate, include_reasoning, gate, model)
+            usage = llm.usage(prefix, prompt_text, completion_tokens)
+            if request.get("stream") or request.get("stream_tokens"):
+                self._send_stream(build_chunks(model, text, finish_reason, usage), llm.sample_latency())
+                return
+            time.sleep(llm.sample_latency(completion_tokens))
+            self._send_json(200, build_body(model, text, finish_reason, usage))
+
+        def log_message(self, format, *args):
+            pass
+
+    return MockHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Azure inference / Together completions server for offline load tests.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", choices=["fixed", "uniform", "lognormal"], default="fixed",
+                        help="distribution of the time to first token")
+    parser.add_argument("--latency-mean", type=float, default=0.5, help="mean time to first token in seconds")
+    parser.add_argument("--latency-sd", type=float, default=0.25, help="spread of the time to first token in seconds")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="extra seconds per generated token")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="probability of answering 429 Too Many Requests")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with injected 429s")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="probability of answering 503 Service Unavailable")
+    parser.add_argument("--truncate-rate", type=float, default=0.0,
+                        help="probability of cutting a response short with finish_reason 'length'")
+    parser.add_argument("--malformed-rate", type=float, default=0.0,
+                        help="probability of dropping or corrupting one comment block of a response")
+    parser.add_argument("--harmful-rate", type=float, default=0.3, help="share of comments given a harmful label")
+    parser.add_argument("--disagree-rate", type=float, default=0.0,
+                        help="share of comments on which each model departs from the shared verdict")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    llm = MockLLM(
+        latency=args.latency, latency_mean=args.latency_mean, latency_sd=args.latency_sd,
+        token_latency=args.token_latency, rate_429=args.rate_429, retry_after=args.retry_after,
+        rate_5xx=args.rate_5xx, truncate_rate=args.truncate_rate, malformed_rate=args.malformed_rate,
+        harmful_rate=args.harmful_rate, disagree_rate=args.disagree_rate, seed=args.seed
+    )
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(llm))
+    server.daemon_threads = True
+    print(f"Mock LLM server listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
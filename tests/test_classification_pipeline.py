@@ -0,0 +1,158 @@
+"""
+Tests of the backend-independent classification pipeline (Prompts/few-shot/classification_pipeline.py).
+No requests are sent: the stages under test are given fake classifiers or a fake backend.
+"""
+
+import os
+import sys
+import asyncio
+import contextlib
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Prompts", "few-shot"))
+import classification_pipeline as pipeline
+
+
+def result(category: str, confidence: float = 0.95) -> dict:
+    return {"classification": [{"category": category, "confidence": confidence}], "reasoning": f"{category} reasoning"}
+
+
+def fake_classifier(labels: dict, omitted: dict = None):
+    """
+    Stand-in for classify_comments: the active model labels every comment with labels[model],
+    except the 1-based positions listed in omitted[model], which it returns no result for.
+    """
+    omitted = omitted or {}
+
+    def classify(comments: list, on_results=None) -> dict:
+        model = pipeline.active_model()
+        results = {k: result(labels[model]) for k in range(1, len(comments) + 1) if k not in omitted.get(model, ())}
+        if on_results and results:
+            on_results(results)
+        return results
+    return classify
+
+
+@pytest.fixture(autouse=True)
+def no_cache(monkeypatch):
+    monkeypatch.setattr(pipeline, "CACHE_PATH", None)
+    monkeypatch.setattr(pipeline, "RATE_LIMITS", {})
+
+
+def test_ensemble_sends_comment_a_voter_omitted_to_tie_breaker(monkeypatch):
+    monkeypatch.setattr(pipeline, "ENSEMBLE_MODELS", ["a", "b", "tie"])
+    monkeypatch.setattr(pipeline, "classify_comments",
+                        fake_classifier({"a": "Discredit", "b": "Discredit", "tie": "Stereotyping"}, {"b": {2}}))
+    reported = {}
+
+    results = pipeline.classify_ensemble(["one", "two", "three"], reported.update)
+
+    assert sorted(results) == [1, 2, 3]
+    assert reported.keys() == results.keys()
+    # Row 2 has one member vote against the tie-breaker's, so neither label has a majority
+    assert results[2]["classification"] == [{"category": "Stereotyping", "confidence": 0.95}]
+    assert results[1]["classification"] == [{"category": "Discredit", "confidence": 0.95}]
+
+
+def test_ensemble_keeps_member_vote_when_tie_breaker_omits_comment(monkeypatch):
+    monkeypatch.setattr(pipeline, "ENSEMBLE_MODELS", ["a", "b", "tie"])
+    monkeypatch.setattr(pipeline, "classify_comments",
+                        fake_classifier({"a": "Discredit", "b": "Discredit", "tie": "None"}, {"a": {1}, "tie": {1}}))
+
+    results = pipeline.classify_ensemble(["one", "two"])
+
+    assert results[1]["classification"] == [{"category": "Discredit", "confidence": 0.95}]
+
+
+def test_cascade_escalates_comment_the_cheap_tier_omitted(monkeypatch):
+    monkeypatch.setattr(pipeline, "CASCADE_MODELS", ["small", "large"])
+    monkeypatch.setattr(pipeline, "CASCADE_ESCALATE_FLAGGED", False)
+    monkeypatch.setattr(pipeline, "classify_comments", fake_classifier({"small": "None", "large": "Discredit"}, {"small": {3}}))
+    reported = {}
+
+    results = pipeline.classify_cascade(["one", "two", "three", "four"], reported.update)
+
+    assert sorted(results) == [1, 2, 3, 4]
+    assert reported.keys() == results.keys()
+    assert results[3]["classification"] == [{"category": "Discredit", "confidence": 0.95}]
+    assert results[1]["classification"] == [{"category": "None", "confidence": 0.95}]
+
+
+def test_journal_resume_drops_torn_last_line(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = pipeline.ResultJournal(path)
+    journal.append({1: result("None")})
+    journal.close()
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"row": 2, "comment_id": null, "res')
+
+    journal = pipeline.ResultJournal(path, resume=True)
+    journal.append({2: result("Discredit"), 3: result("None")})
+    journal.close()
+
+    assert sorted(pipeline.ResultJournal.load(path)) == [1, 2, 3]
+
+
+@pytest.mark.parametrize("gate, reasoning", [(False, True), (False, False), (True, True)])
+def test_packed_batches_get_the_output_allowance_they_were_packed_with(monkeypatch, gate, reasoning):
+    monkeypatch.setattr(pipeline, "GATE_ACTIVE", gate)
+    monkeypatch.setattr(pipeline, "INCLUDE_REASONING", reasoning)
+    budget = 9000
+    comments = [f"comment {i} " + "word " * (i % 40) for i in range(300)]
+    prefix_tokens = pipeline.estimate_tokens(pipeline.classification_prompt())
+
+    batches = pipeline.pack_batches(comments, max_items=100, token_budget=budget)
+
+    assert sum(len(batch) for _, batch in batches) == len(comments)
+    for _, batch in batches:
+        max_tokens = pipeline.completion_tokens_for(len(batch))
+        assert max_tokens == pipeline.output_tokens_per_comment() * len(batch)
+        comment_tokens = sum(pipeline.estimate_tokens(f'\nComment #{j}: "{comment}"') for j, comment in enumerate(batch, 1))
+        assert prefix_tokens + comment_tokens + max_tokens <= budget
+
+
+def test_async_salvage_stays_within_the_concurrency_limit(monkeypatch):
+    in_flight, peak = 0, 0
+
+    async def request_completion_async(payload, client, max_tokens, on_block=None):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        # Answer only the first comment, so the rest of every batch is salvaged
+        return "Comment #1:\nClassification: None (0.9)\nReasoning: ok", False
+
+    @contextlib.asynccontextmanager
+    async def open_async_client(max_concurrency):
+        yield None
+
+    monkeypatch.setattr(pipeline, "SALVAGE_BATCH_SIZE", 1)
+    monkeypatch.setattr(pipeline, "build_batch_request", lambda comments: comments)
+    monkeypatch.setattr(pipeline, "request_completion_async", request_completion_async)
+    monkeypatch.setattr(pipeline, "open_async_client", open_async_client)
+
+    results = asyncio.run(pipeline.classify_in_batches_async([f"comment {i}" for i in range(12)], batch_size=4, max_concurrency=2))
+
+    assert sorted(results) == list(range(1, 13))
+    assert peak <= 2
+
+
+def test_rate_limiter_refunds_at_most_what_it_took():
+    limiter = pipeline.TokenBucketRateLimiter(requests_per_minute=60000, tokens_per_minute=1000)
+
+    # A reservation larger than the bucket only takes the whole bucket
+    limiter.acquire(5000)
+    limiter.settle(5000, 100)
+
+    assert limiter.token_level == pytest.approx(900, abs=1)
+
+
+def test_rate_limiter_failed_attempt_refunds_its_reservation():
+    limiter = pipeline.TokenBucketRateLimiter(requests_per_minute=60000, tokens_per_minute=1000)
+
+    limiter.acquire(400)
+    limiter.settle(400, 0)
+
+    assert limiter.token_level == pytest.approx(1000, abs=1)